@@ -0,0 +1,76 @@
+#!/usr/bin/env python
+"""Measures the cost of importing ``undermythumb`` modules, and checks
+that none of them loads PIL.
+
+Each import runs in a fresh interpreter, timed together with
+``django.setup()``, which imports every installed app's models. It is
+compared with the same import followed by ``PIL.Image``, the cost
+every process paid before imaging was loaded lazily.
+
+Usage: ::
+
+    python benchmarks/import_time.py
+"""
+
+import os
+import subprocess
+import sys
+
+
+ROOT = os.path.realpath(os.path.join(os.path.dirname(__file__),
+                                     os.path.pardir))
+
+MODULES = (
+    'undermythumb.fields',
+    'undermythumb.renderers',
+    'undermythumb.tests.models',
+)
+REPEAT = 10
+
+SCRIPT = """
+import sys, time
+start = time.time()
+import django
+django.setup()
+import %s
+sys.stdout.write('%%f %%d' %% (time.time() - start,
+                               'PIL.Image' in sys.modules))
+"""
+
+
+def run(statement):
+    """Returns the best import time, in milliseconds, and whether PIL
+    was loaded.
+    """
+
+    env = dict(os.environ, PYTHONPATH=ROOT)
+    env.setdefault('DJANGO_SETTINGS_MODULE',
+                   'undermythumb.tests.test_settings')
+
+    command = [sys.executable, '-c', SCRIPT % statement]
+
+    best = None
+    for i in range(REPEAT):
+        process = subprocess.Popen(command, env=env, stdout=subprocess.PIPE,
+                                   stderr=subprocess.PIPE)
+        stdout, _ = process.communicate()
+        seconds, loaded = stdout.split()
+        if best is None or float(seconds) < best:
+            best = float(seconds)
+
+    return best * 1000, bool(int(loaded))
+
+
+def main():
+    print '%-28s %12s %12s %6s' % ('module', 'lazy (ms)', 'eager (ms)',
+                                   'PIL?')
+
+    for module in MODULES:
+        lazy, loaded = run(module)
+        eager = run('%s, PIL.Image' % module)[0]
+        print '%-28s %12.1f %12.1f %6s' % (module, lazy, eager,
+                                           'yes' if loaded else 'no')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,97 @@
+#!/usr/bin/env python
+"""Measures the per-access cost of naming a field's thumbnails.
+
+Each access uses a fresh model instance, as a listing page would,
+so every run populates a new ``ThumbnailSet``.
+
+Usage: ::
+
+    python benchmarks/thumbnail_access.py
+"""
+
+import os
+import sys
+import timeit
+
+
+sys.path.insert(0, os.path.realpath(
+    os.path.join(os.path.dirname(__file__), os.path.pardir)))
+os.environ.setdefault('DJANGO_SETTINGS_MODULE',
+                      'undermythumb.tests.test_settings')
+
+import django
+if hasattr(django, 'setup'):
+    django.setup()
+
+from django.db import models
+
+from undermythumb.fields import ImageWithThumbnailsField
+from undermythumb.files import ThumbnailFieldFile
+from undermythumb.renderers import CropRenderer
+
+
+SIZES = (1, 10, 50)
+NUMBER = 2000
+
+
+def make_model(size_count):
+    thumbnails = tuple(('size_%d' % i, CropRenderer(10 + i, 10 + i))
+                       for i in range(size_count))
+
+    attrs = {
+        '__module__': __name__,
+        'Meta': type('Meta', (), {'app_label': 'tests'}),
+        'artwork': ImageWithThumbnailsField(upload_to='artwork/',
+                                            thumbnails=thumbnails),
+    }
+    return type('BenchmarkPost%d' % size_count, (models.Model, ), attrs)
+
+
+def legacy_populate(field, field_file):
+    """Populates thumbnails as done before specs were compiled."""
+
+    cache = {}
+    for options in field.thumbnails:
+        try:
+            attname, renderer, key = options
+        except ValueError:
+            attname, renderer = options
+            key = attname
+            ext = '.%s' % renderer.format
+
+        name = field.get_thumbnail_filename(
+            instance=field_file.instance,
+            original_file=field_file,
+            thumbnail_name=key,
+            ext=ext)
+
+        cache[attname] = ThumbnailFieldFile(attname, renderer,
+                                            field_file.instance, field, name)
+    return cache
+
+
+def main():
+    print '%6s %14s %14s' % ('sizes', 'legacy (us)', 'compiled (us)')
+
+    for size_count in SIZES:
+        model = make_model(size_count)
+        field = model._meta.get_field('artwork')
+
+        def compiled():
+            post = model(id=1, artwork='artwork/b3d23ba4.jpg')
+            list(post.artwork.thumbnails)
+
+        def legacy():
+            post = model(id=1, artwork='artwork/b3d23ba4.jpg')
+            legacy_populate(field, post.artwork)
+
+        results = []
+        for func in (legacy, compiled):
+            best = min(timeit.repeat(func, number=NUMBER, repeat=3))
+            results.append(best / NUMBER * 1e6)
+
+        print '%6d %14.1f %14.1f' % ((size_count, ) + tuple(results))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,295 @@
+from collections import OrderedDict
+from cStringIO import StringIO
+import math
+import threading
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+
+
+__all__ = ('ImageBackend', 'PILBackend', 'register_backend', 'get_backend',
+           'get_backends')
+
+
+TRANSFORM_CACHE_SIZE = 32
+
+_transforms = OrderedDict()
+_transforms_lock = threading.Lock()
+_srgb_profile = []
+_image_cms = []
+
+# profiles embedded by conversions, which need no further conversion
+_converted_profiles = set()
+
+
+def get_pil_image():
+    """Returns PIL's ``Image`` module, importing it on first use."""
+
+    from PIL import Image
+    return Image
+
+
+def get_image_cms():
+    """Returns PIL's ``ImageCms`` module, or ``None`` when PIL is built
+    without it. It is imported once, on first use.
+    """
+
+    if not _image_cms:
+        try:
+            from PIL import ImageCms
+        except ImportError:
+            ImageCms = None
+        _image_cms.append(ImageCms)
+
+    return _image_cms[0]
+
+
+def get_color_transform(icc_profile, in_mode, out_mode):
+    """Returns a transform from an embedded ICC profile to sRGB.
+
+    Building a transform parses both profiles, so the
+    ``TRANSFORM_CACHE_SIZE`` most recently used transforms are cached
+    per source profile and mode pair.
+    """
+
+    key = (icc_profile, in_mode, out_mode)
+    with _transforms_lock:
+        try:
+            transform = _transforms.pop(key)
+            _transforms[key] = transform
+            return transform
+        except KeyError:
+            pass
+
+    ImageCms = get_image_cms()
+
+    if not _srgb_profile:
+        _srgb_profile.append(ImageCms.createProfile('sRGB'))
+
+    source_profile = ImageCms.ImageCmsProfile(StringIO(icc_profile))
+    transform = ImageCms.buildTransform(source_profile, _srgb_profile[0],
+                                        in_mode, out_mode)
+    _converted_profiles.add(transform.output_profile.tobytes())
+
+    with _transforms_lock:
+        _transforms[key] = transform
+        while len(_transforms) > TRANSFORM_CACHE_SIZE:
+            _transforms.popitem(last=False)
+
+    return transform
+
+
+class ImageBackend(object):
+    """Base class for imaging backends.
+
+    A backend performs every pixel operation the built-in renderers
+    need, on image objects of its own choosing. Subclass this, and
+    register an instance with ``register_backend``, to render with
+    another imaging library.
+    """
+
+    # whether the backend can decode and encode multi-frame images
+    supports_animation = False
+
+    def open(self, content):
+        """Opens ``content``, reading no more than its header."""
+        raise NotImplementedError
+
+    def get_size(self, image):
+        raise NotImplementedError
+
+    def get_mode(self, image):
+        """Returns the image's PIL-style mode, such as ``'RGB'``."""
+        raise NotImplementedError
+
+    def shrink_on_load(self, image, size):
+        """Asks the decoder for the smallest scale at which ``image``
+        is still at least ``size``. Backends may ignore this.
+        """
+        return image
+
+    def decode_region(self, image, box):
+        """Asks the decoder to read no more of ``image`` than ``box``
+        needs. Returns the image, and ``box`` relative to it. Backends
+        may ignore this.
+        """
+        return image, box
+
+    def convert_color(self, image):
+        """Converts ``image`` to RGB, or RGBA, through any embedded
+        ICC profile to sRGB.
+        """
+        raise NotImplementedError
+
+    def resize(self, image, size):
+        raise NotImplementedError
+
+    def fit(self, image, size, box):
+        """Crops ``box`` from ``image``, and resizes it to ``size``.
+        ``box`` may be fractional.
+        """
+        raise NotImplementedError
+
+    def pad(self, image, size, color):
+        """Centers ``image`` on a canvas of ``size``, filled with an
+        RGBA ``color``.
+        """
+        raise NotImplementedError
+
+    def encode(self, image, format, quality):
+        """Returns ``image`` encoded as ``format``, as a string."""
+        raise NotImplementedError
+
+    def to_pil(self, image):
+        """Returns ``image`` as a PIL image."""
+        return get_pil_image().open(StringIO(self.encode(image, 'PNG', 100)))
+
+
+class PILBackend(ImageBackend):
+    """The default backend, built on PIL, which is imported on first
+    use.
+    """
+
+    supports_animation = True
+
+    def open(self, content):
+        content.seek(0)
+        return get_pil_image().open(content)
+
+    def get_size(self, image):
+        return image.size
+
+    def get_mode(self, image):
+        return image.mode
+
+    def shrink_on_load(self, image, size):
+        # only JPEG decoders scale on load; draft is a no-op elsewhere
+        image.draft(image.mode, size)
+        return image
+
+    def decode_region(self, image, box):
+        # only images not yet decoded can be narrowed
+        tiles = getattr(image, 'tile', None)
+        if not tiles or getattr(image, 'im', None) is not None:
+            return image, box
+
+        left, top, right, bottom = box
+
+        if len(tiles) == 1:
+            # a single stream can still stop at the box's last row
+            decoder, extents, offset, args = tiles[0]
+            if (decoder not in ('raw', 'zip') or image.info.get('interlace')
+                    or extents != (0, 0) + image.size):
+                return image, box
+            bottom = min(int(math.ceil(bottom)), image.size[1])
+            tiles = [(decoder, (0, 0, image.size[0], bottom), offset, args)]
+            region = (0, 0, image.size[0], bottom)
+        else:
+            # tiled and striped sources skip the tiles outside the box
+            tiles = [tile for tile in tiles
+                     if tile[1][0] < right and tile[1][2] > left and
+                     tile[1][1] < bottom and tile[1][3] > top]
+            if not tiles:
+                return image, box
+            region = (min(tile[1][0] for tile in tiles),
+                      min(tile[1][1] for tile in tiles),
+                      max(tile[1][2] for tile in tiles),
+                      max(tile[1][3] for tile in tiles))
+
+        x, y = region[:2]
+        image.tile = [
+            (codec, (x0 - x, y0 - y, x1 - x, y1 - y), start, codec_args)
+            for codec, (x0, y0, x1, y1), start, codec_args in tiles]
+
+        size = (region[2] - x, region[3] - y)
+        if hasattr(image, '_size'):
+            image._size = size
+        else:
+            image.size = size
+
+        return image, (left - x, top - y, right - x, bottom - y)
+
+    def convert_color(self, image):
+        icc_profile = image.info.get('icc_profile')
+        if image.mode == 'L':
+            return image
+        if image.mode in ('RGB', 'RGBA') and (
+                not icc_profile or icc_profile in _converted_profiles):
+            return image
+
+        out_mode = 'RGBA' if image.mode == 'RGBA' else 'RGB'
+
+        ImageCms = get_image_cms() if icc_profile else None
+        if (ImageCms is not None and
+                image.mode in ('RGB', 'RGBA', 'CMYK')):
+            try:
+                transform = get_color_transform(icc_profile, image.mode,
+                                                out_mode)
+                return ImageCms.applyTransform(image, transform)
+            except (IOError, ImageCms.PyCMSError):
+                pass
+
+        return image.convert(out_mode)
+
+    def resize(self, image, size):
+        return image.resize(size, get_pil_image().ANTIALIAS)
+
+    def fit(self, image, size, box):
+        Image = get_pil_image()
+        image, box = self.decode_region(image, box)
+        try:
+            # a single resample from the box, with no intermediate crop
+            return image.resize(size, Image.ANTIALIAS, box)
+        except TypeError:
+            box = tuple(int(round(value)) for value in box)
+            return image.crop(box).resize(size, Image.ANTIALIAS)
+
+    def pad(self, image, size, color):
+        width, height = size
+        src_width, src_height = image.size
+
+        canvas = get_pil_image().new('RGBA', size, color)
+        canvas.paste(image, ((width - src_width) / 2,
+                             (height - src_height) / 2))
+        return canvas
+
+    def encode(self, image, format, quality):
+        io = StringIO()
+        image.save(io, format, quality=quality)
+        return io.getvalue()
+
+    def to_pil(self, image):
+        return image
+
+
+_backends = {}
+
+
+def register_backend(name, backend):
+    """Makes an ``ImageBackend`` instance available to renderers as
+    ``name``.
+    """
+
+    _backends[name] = backend
+
+
+def get_backend(name=None):
+    """Returns the backend registered as ``name``, defaulting to the
+    ``UNDERMYTHUMB_IMAGE_BACKEND`` setting, or ``'pil'``.
+    """
+
+    if name is None:
+        name = getattr(settings, 'UNDERMYTHUMB_IMAGE_BACKEND', 'pil')
+
+    try:
+        return _backends[name]
+    except KeyError:
+        raise ImproperlyConfigured('No image backend registered as %r' % name)
+
+
+def get_backends():
+    """Returns the names of all registered backends."""
+    return sorted(_backends)
+
+
+register_backend('pil', PILBackend())
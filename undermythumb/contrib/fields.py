@@ -3,43 +3,73 @@ from django.db import models
 from undermythumb.fields import ImageWithThumbnailsField, ImageFallbackField
 
 
-class PostSaveImageField(ImageWithThumbnailsField):
+DEFERRED_FILES_ATTR = '_deferred_post_save_files'
 
-    def __init__(self, *args, **kwargs):
-        kwargs.update(blank=True, null=True)
-        super(PostSaveImageField, self).__init__(*args, **kwargs)
 
-    def contribute_to_class(self, cls, name):
-        super(PostSaveImageField, self).contribute_to_class(cls, name)
-        models.signals.post_save.connect(self.save_file, sender=cls)
+def save_deferred_files(sender, instance, **kwargs):
+    """Saves every file deferred by an instance's post-save fields,
+    and persists their names in a single ``UPDATE``.
+    """
 
-    def save_file(self, sender, instance, created, **kwargs):
-        img_file = super(PostSaveImageField, self).pre_save(instance, created)
+    deferred = instance.__dict__.pop(DEFERRED_FILES_ATTR, None)
+    if not deferred:
+        return
 
+    values = {}
+    for field in deferred:
+        img_file = field.save_file(instance)
         if img_file:
-            (instance.__class__._default_manager
-             .filter(pk=instance.pk).update(**{self.attname: img_file}))
+            values[field.attname] = img_file
+            for name in getattr(field, 'dependent_fields', ()):
+                values[name] = getattr(instance, name)
+
+    if values:
+        (instance.__class__._default_manager
+         .filter(pk=instance.pk).update(**values))
 
-    def pre_save(self, *args, **kwargs):
-        return ''
 
+class PostSaveFieldMixin(object):
+    """Defers saving a file field's upload until its instance has a
+    primary key.
 
-class PostSaveImageFallbackField(ImageFallbackField):
+    When the primary key is already known, the file is saved as part
+    of the instance's own write. Otherwise the column is left blank,
+    and all deferred files on the instance are saved after the
+    ``INSERT``, and persisted together.
+    """
 
     def __init__(self, *args, **kwargs):
         kwargs.update(blank=True, null=True)
-        super(PostSaveImageFallbackField, self).__init__(*args, **kwargs)
+        super(PostSaveFieldMixin, self).__init__(*args, **kwargs)
 
     def contribute_to_class(self, cls, name):
-        super(PostSaveImageFallbackField, self).contribute_to_class(cls, name)
-        models.signals.post_save.connect(self.save_file, sender=cls)
+        super(PostSaveFieldMixin, self).contribute_to_class(cls, name)
 
-    def save_file(self, sender, instance, created, **kwargs):
-        img_file = super(PostSaveImageFallbackField, self).pre_save(instance, created)
+        # one receiver per model, however many post-save fields it has
+        models.signals.post_save.connect(
+            save_deferred_files, sender=cls,
+            dispatch_uid='%s.%s.%s' % (DEFERRED_FILES_ATTR,
+                                       cls.__module__, cls.__name__))
 
-        if img_file:
-            (instance.__class__._default_manager
-             .filter(pk=instance.pk).update(**{self.attname: img_file}))
+    def save_file(self, instance):
+        return super(PostSaveFieldMixin, self).pre_save(instance, True)
+
+    def pre_save(self, model_instance, add):
+        if model_instance.pk is not None:
+            return super(PostSaveFieldMixin, self).pre_save(model_instance,
+                                                            add)
+
+        deferred = model_instance.__dict__.setdefault(DEFERRED_FILES_ATTR,
+                                                      [])
+        if self not in deferred:
+            deferred.append(self)
 
-    def pre_save(self, *args, **kwargs):
         return ''
+
+
+class PostSaveImageField(PostSaveFieldMixin, ImageWithThumbnailsField):
+    pass
+
+
+class PostSaveImageFallbackField(PostSaveFieldMixin, ImageFallbackField):
+    pass
@@ -1,11 +1,19 @@
+import json
 import os
 
+from django.core.exceptions import ImproperlyConfigured, ObjectDoesNotExist
+from django.db.models import ForeignKey
+from django.db.models.fields import FieldDoesNotExist
 from django.db.models.fields.files import (ImageField,
                                            ImageFieldFile,
                                            ImageFileDescriptor)
 
-from undermythumb.files import (ThumbnailFieldFile,
-                                ImageWithThumbnailsFieldFile)
+from undermythumb.files import ImageWithThumbnailsFieldFile
+from undermythumb.specs import compile_thumbnail_specs
+
+
+# source names are 8 hex characters of their hash, two per shard level
+MAX_SHARD_DEPTH = 4
 
 
 def traverse_fallback_path(instance, fallback_path):
@@ -15,6 +23,9 @@ def traverse_fallback_path(instance, fallback_path):
     If the path is ``article_header.thumbnails.list``,
     the order would be: ``article_header -> thumbnails -> list``.
 
+    Paths may hop across relations, as in ``author.avatar.thumbnails.small``.
+    A missing related object ends the road early.
+
     See also: http://en.wikipedia.org/wiki/The_Hunt_(The_Twilight_Zone)
     """
 
@@ -24,6 +35,9 @@ def traverse_fallback_path(instance, fallback_path):
     while path_bits:
         bit = path_bits.pop(0)
 
+        if value is None:
+            break
+
         try:
             bit = int(bit)
             value = value[bit]
@@ -34,68 +48,219 @@ def traverse_fallback_path(instance, fallback_path):
             if isinstance(value, dict):
                 value = value[bit]
             else:
-                value = getattr(value, bit, None)
+                try:
+                    value = getattr(value, bit, None)
+                except ObjectDoesNotExist:
+                    value = None
+                    break
                 if callable(value):
                     value = value()
 
     return value
 
 
+def get_fallback_relations(model):
+    """Finds every relation crossed by the fallback paths of a model's
+    fields, including fallback fields reached through other fallbacks.
+
+    Returns a dict mapping ``select_related`` lookups, such as
+    ``author`` or ``author__profile``, to a ``(model, field_names)``
+    tuple naming the related model and the fields fallbacks read on it.
+    """
+
+    relations = {}
+    seen = set()
+
+    def plan(model, lookup, path_bits):
+        if not path_bits:
+            return
+
+        try:
+            field = model._meta.get_field(path_bits[0])
+        except FieldDoesNotExist:
+            return
+
+        if lookup:
+            relations[lookup][1].add(field.name)
+
+        if isinstance(field, ForeignKey):
+            related_lookup = '__'.join(filter(None, (lookup, field.name)))
+            relations.setdefault(related_lookup, (field.rel.to, set()))
+            plan(field.rel.to, related_lookup, path_bits[1:])
+        elif getattr(field, 'fallback_path', None):
+            key = (model, lookup, field.name)
+            if key not in seen:
+                seen.add(key)
+                for fallback_path in field.fallback_paths:
+                    plan(model, lookup, fallback_path.split('.'))
+
+    for field in model._meta.fields:
+        if getattr(field, 'fallback_path', None):
+            seen.add((model, '', field.name))
+            for fallback_path in field.fallback_paths:
+                plan(model, '', fallback_path.split('.'))
+
+    return relations
+
+
 class FallbackFieldDescriptor(ImageFileDescriptor):
 
     def __get__(self, instance, owner):
         """Returns a field's image. If no image is found, this descriptor
-        inspects and traverses its field's ``fallback_path``,
-        to find and return whatever lies at the end of the path.
+        inspects and traverses its field's ``fallback_paths`` in order,
+        and returns whatever lies at the end of the first path leading
+        to a non-empty value.
+
+        Emptiness is decided from file names alone, so storage
+        is never consulted.
         """
 
-        # if this particular field is empty, return the url
-        # of the mirror field's thumbnail
         value = super(FallbackFieldDescriptor, self).__get__(instance, owner)
 
         # if given a real value, mark as non-empty and return
-        if (isinstance(value, (ImageFieldFile,
-                               ThumbnailFieldFile,
-                               ImageWithThumbnailsFieldFile,
-                               ImageFallbackField))
-            and hasattr(value, 'url')):
+        if value.name:
             value._empty = False
             return value
 
         # this value has no content. mark it as empty.
         value._empty = True
 
-        # check to see if this image has a fallback path
-        # no fallback path? check to see if the field
-        # has a name, mark as empty/filled, and return.
-        if self.field.fallback_path is None:
-            if getattr(value, 'name'):
-                value._empty = False
+        if not self.field.fallback_paths:
             return value
 
-        # using the instance, trace through the fallback path
-        mirror_value = traverse_fallback_path(instance,
-                                              self.field.fallback_path)
+        # using the instance, trace through each fallback path,
+        # stopping at the first one which leads somewhere
+        for fallback_path in self.field.fallback_paths:
+            mirror_value = traverse_fallback_path(instance, fallback_path)
+            if mirror_value is None:
+                continue
 
-        if mirror_value is None:
-            return None
+            try:
+                mirror_value._empty = True
+            except AttributeError:
+                pass
 
-        mirror_value._empty = True
+            if mirror_value:
+                break
 
         return mirror_value
 
 
+def get_fallback_paths(fallback_path):
+    """Normalizes a ``fallback_path`` argument, either a single dotted
+    path or a sequence of them, into a tuple of paths.
+    """
+
+    if not fallback_path:
+        return ()
+    if isinstance(fallback_path, basestring):
+        return (fallback_path, )
+    return tuple(fallback_path)
+
+
 class ImageWithThumbnailsField(ImageField):
     """An ``ImageField`` subclass, extended with zero to many thumbnails.
+
+    Like ``width_field`` and ``height_field``, ``focus_x_field`` and
+    ``focus_y_field`` name model fields holding the image's focal point,
+    as fractions of its width and height. Renderers which crop anchor
+    on it. With ``auto_focus``, an empty focal point is guessed from
+    the image when it is saved.
+
+    ``metadata_field`` names a text field, declared after this one, in
+    which each thumbnail's average color and inline placeholder are
+    stored as compact JSON when thumbnails are rendered.
+
+    With ``shard_depth``, each source is stored in a directory of its
+    own, nested under ``shard_depth`` levels of two-character hash
+    prefixes, as in ``artwork/ab/cd/abcdef12/abcdef12.jpg``, up to
+    ``MAX_SHARD_DEPTH`` levels. Thumbnails sit beside their source.
     """
     attr_class = ImageWithThumbnailsFieldFile
     descriptor_class = FallbackFieldDescriptor
 
-    def __init__(self, thumbnails=None, fallback_path=None, *args, **kwargs):
+    def __init__(self, thumbnails=None, fallback_path=None,
+                 focus_x_field=None, focus_y_field=None, auto_focus=False,
+                 metadata_field=None, shard_depth=0, *args, **kwargs):
         super(ImageWithThumbnailsField, self).__init__(*args, **kwargs)
 
+        if (not isinstance(shard_depth, (int, long)) or
+                not 0 <= shard_depth <= MAX_SHARD_DEPTH):
+            raise ImproperlyConfigured(
+                'shard_depth must be an integer from 0 to %d, not %r' %
+                (MAX_SHARD_DEPTH, shard_depth))
+
         self.thumbnails = thumbnails or []
         self.fallback_path = fallback_path
+        self.fallback_paths = get_fallback_paths(fallback_path)
+        self.focus_x_field = focus_x_field
+        self.focus_y_field = focus_y_field
+        self.auto_focus = auto_focus
+        self.metadata_field = metadata_field
+        self.shard_depth = shard_depth
+        self.thumbnail_specs = ()
+
+    def contribute_to_class(self, cls, name):
+        super(ImageWithThumbnailsField, self).contribute_to_class(cls, name)
+
+        # validate thumbnail definitions once, up front
+        self.thumbnail_specs = compile_thumbnail_specs(self.thumbnails)
+
+    def get_shard_directory(self, hash_value):
+        """Returns the directory holding a source, and its thumbnails,
+        relative to ``upload_to``.
+        """
+
+        bits = [hash_value[i * 2:i * 2 + 2] for i in range(self.shard_depth)]
+        return os.path.join(*(bits + [hash_value]))
+
+    def generate_filename(self, instance, filename):
+        name = super(ImageWithThumbnailsField, self).generate_filename(
+            instance, filename)
+
+        if not self.shard_depth:
+            return name
+
+        path, basename = os.path.split(name)
+        hash_value = os.path.splitext(basename)[0]
+        return os.path.join(path, self.get_shard_directory(hash_value),
+                            basename)
+
+    @property
+    def dependent_fields(self):
+        """Names of model fields written when this field's file is saved.
+        """
+
+        return [name for name in (self.focus_x_field, self.focus_y_field,
+                                  self.metadata_field) if name]
+
+    def get_thumbnail_metadata(self, instance):
+        """Returns the metadata stored for ``instance``'s thumbnails,
+        keyed by thumbnail name. The parsed value is cached on the
+        instance until the stored value changes.
+        """
+
+        if not self.metadata_field:
+            return {}
+
+        value = getattr(instance, self.metadata_field)
+        cache_name = '_%s_metadata_cache' % self.name
+        cached = instance.__dict__.get(cache_name)
+
+        if cached is None or cached[0] != value:
+            try:
+                metadata = json.loads(value) if value else {}
+            except ValueError:
+                metadata = {}
+            cached = instance.__dict__[cache_name] = (value, metadata)
+
+        return cached[1]
+
+    def set_thumbnail_metadata(self, instance, metadata):
+        if self.metadata_field:
+            setattr(instance, self.metadata_field,
+                    json.dumps(metadata, separators=(',', ':'),
+                               sort_keys=True))
 
     def get_thumbnail_filename(self, instance, original_file,
                                thumbnail_name, ext):
@@ -125,6 +290,31 @@ class ImageWithThumbnailsField(ImageField):
 
         return os.path.join(path, filename)
 
+    def get_thumbnail_filenames(self, instance, original_file):
+        """Returns filenames for every thumbnail in ``thumbnail_specs``,
+        in order.
+
+        The source filename is split once, and each name is built from
+        its spec's precompiled template. Subclasses overriding
+        ``get_thumbnail_filename`` are still honoured.
+        """
+
+        specs = self.thumbnail_specs
+
+        if (self.get_thumbnail_filename.__func__ is not
+                ImageWithThumbnailsField.get_thumbnail_filename.__func__):
+            return [self.get_thumbnail_filename(instance=instance,
+                                                original_file=original_file,
+                                                thumbnail_name=spec.key,
+                                                ext=spec.ext)
+                    for spec in specs]
+
+        path, basename = os.path.split(original_file.name)
+        hash_value = os.path.splitext(basename)[0]
+        prefix = os.path.join(path, '')
+
+        return [spec.get_filename(prefix, hash_value) for spec in specs]
+
     def south_field_triple(self):
         """Return a description of this field for South.
         """
@@ -141,6 +331,16 @@ class ImageWithThumbnailsField(ImageField):
             kwargs['thumbnails'] = self.thumbnails
         if self.fallback_path is not None:
             kwargs['fallback_path'] = self.fallback_path
+        if self.focus_x_field is not None:
+            kwargs['focus_x_field'] = self.focus_x_field
+        if self.focus_y_field is not None:
+            kwargs['focus_y_field'] = self.focus_y_field
+        if self.auto_focus:
+            kwargs['auto_focus'] = self.auto_focus
+        if self.metadata_field is not None:
+            kwargs['metadata_field'] = self.metadata_field
+        if self.shard_depth:
+            kwargs['shard_depth'] = self.shard_depth
 
         return name, path, args, kwargs
 
@@ -148,6 +348,9 @@ class ImageWithThumbnailsField(ImageField):
 class ImageFallbackField(ImageField):
     """A special ``ImageField`` subclass for defining an image field
     capable of falling back to the value of another field if empty.
+
+    ``fallback_path`` is a dotted path, or a list of them to be tried
+    in order.
     """
     descriptor_class = FallbackFieldDescriptor
 
@@ -155,6 +358,7 @@ class ImageFallbackField(ImageField):
         kwargs.update(blank=True, null=True)
         super(ImageFallbackField, self).__init__(*args, **kwargs)
         self.fallback_path = fallback_path
+        self.fallback_paths = get_fallback_paths(fallback_path)
 
     def get_db_prep_value(self, value, connection, prepared=False):
         """Ensures that a given value comes from *this* field instance,
@@ -1,10 +1,42 @@
+from collections import OrderedDict
 from hashlib import sha1
 import os
+import threading
 
+from django.core.files.base import ContentFile
 from django.db.models.fields.files import ImageFieldFile
 
+from undermythumb.renderers import find_focal_point
+from undermythumb.scheduler import get_render_pool
+from undermythumb.storage import publish
 
-__all__ = ('ThumbnailFieldFile', 'ImageWithThumbnailsFieldFile')
+
+__all__ = ('ThumbnailFieldFile', 'ImageWithThumbnailsFieldFile',
+           'PendingSave')
+
+
+# qualities chosen for byte-budget thumbnails, by thumbnail name, for
+# fields without a metadata field to keep them in
+QUALITY_CACHE_SIZE = 1024
+
+_qualities = OrderedDict()
+_qualities_lock = threading.Lock()
+
+
+def get_recorded_quality(name):
+    with _qualities_lock:
+        quality = _qualities.pop(name, None)
+        if quality is not None:
+            _qualities[name] = quality
+        return quality
+
+
+def record_quality(name, quality):
+    with _qualities_lock:
+        _qualities.pop(name, None)
+        _qualities[name] = quality
+        while len(_qualities) > QUALITY_CACHE_SIZE:
+            _qualities.popitem(last=False)
 
 
 class ThumbnailSet(object):
@@ -18,29 +50,18 @@ class ThumbnailSet(object):
 
     def _populate(self):
         if not self._cache and self.file.name and self.instance:
-            for options in self.field.thumbnails:
-                try:
-                    attname, renderer, key = options
-                except ValueError:
-                    attname, renderer = options
-                    key = attname
-                    ext = '.%s' % renderer.format
-
-                name = self.field.get_thumbnail_filename(
-                    instance=self.instance,
-                    original_file=self.file,
-                    thumbnail_name=key,
-                    ext=ext)
-
-                thumbnail = ThumbnailFieldFile(
-                    attname,
-                    renderer,
+            specs = self.field.thumbnail_specs
+            names = self.field.get_thumbnail_filenames(self.instance,
+                                                       self.file)
+
+            for spec, name in zip(specs, names):
+                self._cache[spec.attname] = ThumbnailFieldFile(
+                    spec.attname,
+                    spec.renderer,
                     self.instance,
                     self.field,
                     name)
 
-                self._cache[attname] = thumbnail
-
     def clear_cache(self):
         self._cache = {}
 
@@ -68,6 +89,36 @@ class ThumbnailFieldFile(ImageFieldFile):
     def save(self):
         raise NotImplemented('Thumbnails cannot be saved directly.')
 
+    def generate(self, content, focal_point=None, metadata=None,
+                 describe=True):
+        """Renders this thumbnail from the source ``content``.
+
+        ``metadata``, when given, is filled by the renderer, with the
+        color and placeholder only if ``describe`` is true.
+        """
+
+        if self.renderer.uses_focal_point:
+            return self.renderer.generate(content, metadata=metadata,
+                                          describe=describe,
+                                          focal_point=focal_point)
+        return self.renderer.generate(content, metadata=metadata,
+                                      describe=describe)
+
+    @property
+    def metadata(self):
+        return self.field.get_thumbnail_metadata(self.instance).get(
+            self.attname, {})
+
+    @property
+    def color(self):
+        """This thumbnail's average color, as a hex string."""
+        return self.metadata.get('color')
+
+    @property
+    def placeholder(self):
+        """A tiny blurred preview of this thumbnail, as a data URI."""
+        return self.metadata.get('placeholder')
+
 
 class ImageWithThumbnailsFieldFile(ImageFieldFile):
     """File container for an ``ImageWithThumbnailsField``.
@@ -77,20 +128,206 @@ class ImageWithThumbnailsFieldFile(ImageFieldFile):
         super(ImageWithThumbnailsFieldFile, self).__init__(*args, **kwargs)
         self.thumbnails = ThumbnailSet(self)
 
-    def save(self, name, content, save=True):
+    def _get_focal_point(self):
+        x_field = self.field.focus_x_field
+        y_field = self.field.focus_y_field
+        if not (x_field and y_field):
+            return getattr(self, '_focal_point', None)
+
+        x = getattr(self.instance, x_field)
+        y = getattr(self.instance, y_field)
+        if x is None or y is None:
+            return None
+        return (float(x), float(y))
+
+    def _set_focal_point(self, focal_point):
+        # points set before an upload are kept for it
+        self._focal_point = focal_point
+        self._explicit_focus = focal_point is not None
+
+        x_field = self.field.focus_x_field
+        y_field = self.field.focus_y_field
+        if x_field and y_field:
+            x, y = focal_point or (None, None)
+            setattr(self.instance, x_field, x)
+            setattr(self.instance, y_field, y)
+
+    focal_point = property(_get_focal_point, _set_focal_point)
+
+    def _save_source(self, name, content):
         # set file name to first 8 chars of hash of contents
         _, ext = os.path.splitext(name)
         file_hash = sha1(content.read()).hexdigest()[:8]
         name = file_hash + ext
 
+        # a replaced source's focal point doesn't fit the new one
+        if self._committed:
+            replacing = bool(self.name)
+        else:
+            replacing = self.instance.pk is not None
+        if (replacing and name != self.name and
+                not getattr(self, '_explicit_focus', False)):
+            self.focal_point = None
+
+        # guess a focal point once, before any thumbnails are cut
+        if self.field.auto_focus and self.focal_point is None:
+            self.focal_point = find_focal_point(content)
+        self._explicit_focus = False
+
         # save source file
-        super(ImageWithThumbnailsFieldFile, self).save(name, content, save)
+        super(ImageWithThumbnailsFieldFile, self).save(name, content,
+                                                       save=False)
 
         self.thumbnails.clear_cache()
 
+    def save(self, name, content, save=True):
+        self._save_source(name, content)
+        self.publish_thumbnails(content)
+
+        if save:
+            self.instance.save()
+
+    def publish_thumbnails(self, content):
+        """Renders and stores every thumbnail of the source ``content``,
+        and records their metadata on the instance, without saving it.
+        """
+
+        metadata = {}
         for thumbnail in self.thumbnails:
-            rendered = thumbnail.renderer.generate(content)
-            self.field.storage.save(thumbnail.name, rendered)
+            rendered = self.generate_thumbnail(thumbnail, content, metadata)
+            publish(self.field.storage, thumbnail.name, rendered)
+
+        self.field.set_thumbnail_metadata(self.instance, metadata)
+
+    def save_async(self, name, content, save=True):
+        """Like ``save``, but renders and stores every thumbnail
+        concurrently, on the render pool.
+
+        The source is stored before returning. Returns a
+        ``PendingSave``; the instance is saved when it is waited on.
+        """
+
+        self._save_source(name, content)
+
+        content.seek(0)
+        data = content.read()
+
+        metadata = {}
+        results = [
+            get_render_pool().apply_async(
+                self._publish_thumbnail,
+                (thumbnail, ContentFile(data), metadata))
+            for thumbnail in self.thumbnails]
+
+        return PendingSave(self, results, metadata, save)
+
+    def _publish_thumbnail(self, thumbnail, content, metadata):
+        rendered = self.generate_thumbnail(thumbnail, content, metadata)
+        return publish(self.field.storage, thumbnail.name, rendered)
+
+    def generate_thumbnail(self, thumbnail, content, metadata):
+        """Renders a thumbnail, collecting its metadata into
+        ``metadata`` when the field stores it, or only the quality when
+        the renderer has a byte budget.
+
+        The quality a byte-budget encode settles on is also recorded
+        in this process, by thumbnail name, so it is reused when the
+        thumbnail is regenerated even without a metadata field.
+        """
+
+        if not (self.field.metadata_field or
+                getattr(thumbnail.renderer, 'max_bytes', None)):
+            return thumbnail.generate(content, self.focal_point)
+
+        # keep the last chosen quality, to speed up byte-budget encodes
+        previous = metadata.get(thumbnail.attname) or {}
+        metadata[thumbnail.attname] = thumbnail_metadata = {}
+        quality = (previous.get('quality') or
+                   get_recorded_quality(thumbnail.name))
+        if quality:
+            thumbnail_metadata['quality'] = quality
+
+        rendered = thumbnail.generate(
+            content, self.focal_point, thumbnail_metadata,
+            describe=bool(self.field.metadata_field))
+        if 'quality' in thumbnail_metadata:
+            record_quality(thumbnail.name, thumbnail_metadata['quality'])
+        return rendered
+
+    def set_focal_point(self, x, y, save=True):
+        """Moves the focal point, and re-renders only the thumbnails
+        whose crop it changes. The source file is neither re-saved
+        nor re-hashed.
+
+        Returns the re-rendered thumbnails.
+        """
+
+        previous = self.focal_point
+        self.focal_point = (x, y)
+        if self.name:
+            # the point belongs to this source, not the next upload
+            self._explicit_focus = False
+
+        rerendered = []
+        if self.name:
+            size = (self.width, self.height)
+            rerendered = [
+                thumbnail for thumbnail in self.thumbnails
+                if thumbnail.renderer.uses_focal_point and
+                (thumbnail.renderer.get_crop_box(size, previous) !=
+                 thumbnail.renderer.get_crop_box(size, self.focal_point))]
+
+        if rerendered:
+            self.open()
+            try:
+                content = ContentFile(self.read())
+            finally:
+                self.close()
+
+            metadata = dict(self.field.get_thumbnail_metadata(self.instance))
+            for thumbnail in rerendered:
+                rendered = self.generate_thumbnail(thumbnail, content,
+                                                    metadata)
+                publish(self.field.storage, thumbnail.name, rendered)
+            self.field.set_thumbnail_metadata(self.instance, metadata)
 
         if save:
             self.instance.save()
+
+        return rerendered
+
+
+class PendingSave(object):
+    """Thumbnails being rendered and stored by ``save_async``.
+    """
+
+    def __init__(self, field_file, results, metadata, save):
+        self.field_file = field_file
+        self.results = results
+        self.metadata = metadata
+        self.save = save
+        self.done = False
+
+    def ready(self):
+        return all(result.ready() for result in self.results)
+
+    def wait(self, timeout=None):
+        """Blocks until every thumbnail is stored, then records their
+        metadata, and saves the instance if asked to.
+
+        Errors from renders or storage are raised here. ``timeout``
+        applies to each thumbnail in turn.
+        """
+
+        if self.done:
+            return
+
+        for result in self.results:
+            result.get(timeout)
+
+        field_file = self.field_file
+        field_file.field.set_thumbnail_metadata(field_file.instance,
+                                                self.metadata)
+        if self.save:
+            field_file.instance.save()
+        self.done = True
@@ -0,0 +1,133 @@
+from itertools import islice
+
+from django.db import DatabaseError, transaction
+
+from undermythumb.scheduler import get_render_pool
+
+
+__all__ = ('bulk_ingest',)
+
+
+def get_update_fields(field):
+    """Returns the names of the columns a source upload writes."""
+
+    return [name for name in
+            ([field.attname, field.width_field, field.height_field] +
+             list(getattr(field, 'dependent_fields', ())))
+            if name]
+
+
+def discard_files(instance, field_name):
+    """Deletes the stored source and thumbnails of an instance which
+    failed to ingest, unless a saved row references the same source.
+    """
+
+    field_file = getattr(instance, field_name)
+    if not field_file.name:
+        return
+
+    model = instance.__class__
+    if model._base_manager.filter(**{field_name: field_file.name}).exists():
+        return
+
+    for name in [thumbnail.name for thumbnail in field_file.thumbnails] + [
+            field_file.name]:
+        try:
+            field_file.storage.delete(name)
+        except (IOError, OSError):
+            pass
+
+
+def ingest_file(instance, field_name, content):
+    """Stores a source and its thumbnails, without saving
+    ``instance``.
+    """
+
+    field_file = getattr(instance, field_name)
+    field_file._save_source(content.name, content)
+    field_file.publish_thumbnails(content)
+    return instance
+
+
+def save_batch(model, instances, update_fields, errors):
+    """Inserts new instances with ``bulk_create``, and updates existing
+    ones in a single transaction. Falls back to saving one at a time,
+    to find the failing rows, when the batch fails.
+    """
+
+    created = [instance for instance in instances if instance.pk is None]
+    updated = [instance for instance in instances if instance.pk is not None]
+
+    try:
+        with transaction.atomic():
+            if created:
+                model._default_manager.bulk_create(created)
+            for instance in updated:
+                model._default_manager.filter(pk=instance.pk).update(**dict(
+                    (name, getattr(instance, name)) for name in update_fields))
+        return instances
+    except DatabaseError:
+        pass
+
+    saved = []
+    for instance in instances:
+        try:
+            with transaction.atomic():
+                if instance.pk is None:
+                    instance.save()
+                else:
+                    instance.save(update_fields=update_fields)
+        except DatabaseError, e:
+            errors.append((instance, e))
+        else:
+            saved.append(instance)
+    return saved
+
+
+def bulk_ingest(model, field_name, items, batch_size=100):
+    """Uploads many images to ``model``'s ``field_name``.
+
+    ``items`` is an iterable of ``(instance, file)`` pairs. Hashing,
+    rendering and storage writes run on the render pool, and each
+    batch of ``batch_size`` is written with one ``bulk_create``, and
+    one transaction of updates. Instances are never saved one by one,
+    unless their batch fails.
+
+    Returns a list of the ingested instances, and a list of
+    ``(instance, exception)`` pairs for those which failed, whose files
+    are deleted. New instances are not given primary keys by
+    ``bulk_create``.
+    """
+
+    field = model._meta.get_field(field_name)
+    update_fields = get_update_fields(field)
+    pool = get_render_pool()
+
+    ingested = []
+    errors = []
+
+    items = iter(items)
+    while True:
+        batch = list(islice(items, batch_size))
+        if not batch:
+            break
+
+        results = [(instance, pool.apply_async(ingest_file,
+                                               (instance, field_name, content)))
+                   for instance, content in batch]
+
+        failed = len(errors)
+        stored = []
+        for instance, result in results:
+            try:
+                stored.append(result.get())
+            except Exception, e:
+                errors.append((instance, e))
+
+        ingested.extend(save_batch(model, stored, update_fields, errors))
+
+        # sources stored for failed items are referenced by nothing
+        for instance, e in errors[failed:]:
+            discard_files(instance, field_name)
+
+    return ingested, errors
@@ -1,9 +1,42 @@
 from optparse import make_option
+import time
 
+from django.core.exceptions import FieldError, ValidationError
 from django.core.files.base import ContentFile
 from django.db.models.fields import FieldDoesNotExist
 from django.db.models.loading import get_model
 from django.core.management.base import BaseCommand, CommandError
+from django.utils.dateparse import parse_date, parse_datetime
+
+from undermythumb.backends import get_backend
+from undermythumb.storage import publish
+
+
+# literal values accepted by --filter
+FILTER_LITERALS = {'True': True, 'False': False, 'None': None}
+
+
+def parse_filter(expression):
+    """Parses a ``lookup=value`` expression into a keyword argument
+    for ``filter``.
+    """
+
+    try:
+        lookup, value = expression.split('=', 1)
+    except ValueError:
+        raise CommandError('Invalid filter %r, expected lookup=value' %
+                           expression)
+    return lookup, FILTER_LITERALS.get(value, value)
+
+
+def read_ids(path):
+    """Reads primary keys from a file, one per line."""
+
+    try:
+        with open(path) as ids_file:
+            return [line.strip() for line in ids_file if line.strip()]
+    except IOError, e:
+        raise CommandError('Could not read ids from %s: %s' % (path, e))
 
 
 class Command(BaseCommand):
@@ -16,6 +49,30 @@ class Command(BaseCommand):
             help='Field name of thumbnail field.'),
         make_option('-s', '--size',
             dest='sizes', action='append'),
+        make_option('--min-pk',
+            dest='min_pk', action='store',
+            help='Only rows with a primary key of at least this.'),
+        make_option('--max-pk',
+            dest='max_pk', action='store',
+            help='Only rows with a primary key of at most this.'),
+        make_option('--since',
+            dest='since', action='store',
+            help='Only rows whose --date-field is on or after this date.'),
+        make_option('--date-field',
+            dest='date_field', action='store',
+            help='Date or datetime field compared with --since.'),
+        make_option('--ids-file',
+            dest='ids_file', action='store',
+            help='File of primary keys to process, one per line.'),
+        make_option('--filter',
+            dest='filters', action='append', default=[],
+            help='A lookup=value queryset filter. May be repeated.'),
+        make_option('--estimate',
+            dest='estimate', action='store_true', default=False,
+            help='Project the cost of a run, without rendering it.'),
+        make_option('--sample',
+            dest='sample', action='store', type='int', default=20,
+            help='Number of sources sampled by --estimate.'),
     )
     help = ("Selectively creates thumbnails for a model's "
             "image thumbnail field.")
@@ -42,18 +99,124 @@ class Command(BaseCommand):
         if sizes is None:
             raise CommandError('Must specify sizes, -s or --size')
 
-        thumbnails = [t[0] for t in field.thumbnails for s in sizes]
+        thumbnails = [spec.attname for spec in field.thumbnail_specs]
         invalid_sizes = [s for s in sizes if s not in thumbnails]
         if invalid_sizes:
             raise CommandError('No thumbnails for sizes %r' % invalid_sizes)
 
-        objects = model._default_manager.only(field_name)
+        objects = self.get_queryset(model, field_name, options).only(
+            field_name, *getattr(field, 'dependent_fields', ()))
+
+        if options.get('estimate'):
+            return self.estimate(objects, field_name, sizes,
+                                 options['sample'])
+
         for obj in objects:
             field_instance = getattr(obj, field_name)
             self.create_thumbnails(field_instance, sizes)
 
         self.stdout.write('Done.\n')
 
+    def get_queryset(self, model, field_name, options):
+        """Applies the selection options to ``model``'s rows, skipping
+        rows without a source.
+        """
+
+        queryset = model._default_manager.exclude(**{field_name: ''})
+
+        if options.get('min_pk') is not None:
+            queryset = queryset.filter(pk__gte=options['min_pk'])
+        if options.get('max_pk') is not None:
+            queryset = queryset.filter(pk__lte=options['max_pk'])
+
+        if options.get('since'):
+            date_field = options.get('date_field')
+            if not date_field:
+                raise CommandError('--since needs a --date-field')
+            since = (parse_datetime(options['since']) or
+                     parse_date(options['since']))
+            if since is None:
+                raise CommandError('Invalid date %s' % options['since'])
+            queryset = queryset.filter(**{'%s__gte' % date_field: since})
+
+        if options.get('ids_file'):
+            queryset = queryset.filter(pk__in=read_ids(options['ids_file']))
+
+        try:
+            queryset = queryset.filter(**dict(
+                parse_filter(expression)
+                for expression in options.get('filters') or ()))
+        except (FieldError, ValidationError, ValueError), e:
+            raise CommandError('Invalid filter: %s' % e)
+
+        return queryset
+
+    def estimate(self, objects, field_name, sizes, sample_size):
+        """Projects decode pixels, render time and output bytes for
+        ``objects`` from a random sample of their sources.
+
+        Only the header of most samples is read; the first few sources
+        are read whole, and rendered in memory, to time renders per
+        megapixel.
+        """
+
+        backend = get_backend()
+        count = objects.count()
+        sampled = list(objects.order_by('?')[:sample_size])
+
+        pixels = []
+        rendered_pixels = render_time = output_bytes = renders = 0
+        for obj in sampled:
+            field_instance = getattr(obj, field_name)
+
+            # renders are slow; time only a handful
+            render = len(pixels) < 5
+            try:
+                field_instance.open()
+                try:
+                    width, height = backend.get_size(
+                        backend.open(field_instance))
+                    if render:
+                        field_instance.seek(0)
+                        content = ContentFile(field_instance.read())
+                finally:
+                    field_instance.close()
+            except IOError:
+                continue
+            pixels.append(width * height)
+
+            if not render:
+                continue
+            for thumbnail in field_instance.thumbnails:
+                if thumbnail.attname not in sizes:
+                    continue
+                start = time.time()
+                rendered = thumbnail.generate(content,
+                                              field_instance.focal_point)
+                render_time += time.time() - start
+                rendered_pixels += width * height
+                output_bytes += rendered.size
+                renders += 1
+
+        if not pixels:
+            self.stdout.write('Selected %d rows, none readable.\n' % count)
+            return
+
+        mean_pixels = sum(pixels) / float(len(pixels))
+        total_pixels = mean_pixels * count * len(sizes)
+        seconds_per_pixel = render_time / (rendered_pixels or 1)
+        bytes_per_render = output_bytes / float(renders or 1)
+
+        self.stdout.write(
+            'Selected %d rows, sampled %d.\n'
+            'Mean source: %.1f megapixels.\n'
+            'Projected decode: %.1f megapixels.\n'
+            'Projected render time: %.1f seconds.\n'
+            'Projected output: %.1f MB.\n' % (
+                count, len(pixels), mean_pixels / 1e6, total_pixels / 1e6,
+                total_pixels * seconds_per_pixel,
+                bytes_per_render * count * len(sizes) / 1e6))
+
     def create_thumbnails(self, field_instance, sizes):
         thumbnails = [t for t in field_instance.thumbnails
                       if t.attname in sizes]
@@ -68,13 +231,25 @@ class Command(BaseCommand):
             content = ContentFile(field_instance.read())
         except IOError:
             return
+
+        field = field_instance.field
+        metadata = dict(field.get_thumbnail_metadata(field_instance.instance))
         for thumbnail in thumbnails:
-            self.create_thumbnail(thumbnail, content)
+            self.create_thumbnail(field_instance, thumbnail, content, metadata)
+
+        # keep stored colors and placeholders in step with the thumbnails
+        if field.metadata_field:
+            instance = field_instance.instance
+            field.set_thumbnail_metadata(instance, metadata)
+            (instance.__class__._default_manager.filter(pk=instance.pk)
+             .update(**{field.metadata_field:
+                        getattr(instance, field.metadata_field)}))
 
-    def create_thumbnail(self, thumbnail, content):
+    def create_thumbnail(self, field_instance, thumbnail, content, metadata):
         self.stdout.write('Creating thumbnail %s ...\n' % thumbnail.url)
         try:
-            rendered = thumbnail.renderer.generate(content)
-            thumbnail.storage.save(thumbnail.name, rendered)
+            rendered = field_instance.generate_thumbnail(thumbnail, content,
+                                                         metadata)
+            publish(thumbnail.storage, thumbnail.name, rendered)
         except Exception, exc:
-            print exc
+            self.stderr.write('%s\n' % exc)
@@ -0,0 +1,217 @@
+from datetime import datetime, timedelta
+import heapq
+from itertools import islice
+from optparse import make_option
+import posixpath
+import tempfile
+import time
+
+from django.db.models import FileField
+from django.db.models.fields import FieldDoesNotExist
+from django.db.models.fields.files import FieldFile
+from django.db.models.loading import get_model, get_models
+from django.core.management.base import BaseCommand, CommandError
+from django.utils.encoding import force_text
+
+from undermythumb.sprites import is_sprite_file
+
+
+def walk_storage(storage, path):
+    """Lists every file under ``path`` in ``storage``, one directory
+    at a time.
+    """
+
+    directories, files = storage.listdir(path)
+
+    for filename in files:
+        yield posixpath.join(path, force_text(filename))
+
+    for directory in directories:
+        for name in walk_storage(storage,
+                                 posixpath.join(path, force_text(directory))):
+            yield name
+
+
+def iter_sorted(names, chunk_size=100000):
+    """Sorts and de-duplicates ``names``, holding no more than
+    ``chunk_size`` of them in memory. Larger inputs are sorted in
+    chunks, spilled to temporary files, and merged.
+    """
+
+    names = iter(names)
+    chunks = []
+
+    try:
+        while True:
+            chunk = sorted(islice(names, chunk_size))
+            if not chunk:
+                break
+            if not chunks and len(chunk) < chunk_size:
+                chunks.append(chunk)
+                break
+
+            spill = tempfile.TemporaryFile()
+            spill.writelines('%s\n' % name.encode('utf-8') for name in chunk)
+            spill.seek(0)
+            chunks.append(spill)
+
+        streams = [
+            stream if isinstance(stream, list) else
+            (line[:-1].decode('utf-8') for line in stream)
+            for stream in chunks]
+
+        previous = None
+        for name in heapq.merge(*streams):
+            if name != previous:
+                yield name
+                previous = name
+    finally:
+        for chunk in chunks:
+            if not isinstance(chunk, list):
+                chunk.close()
+
+
+def iter_orphans(stored, referenced):
+    """Yields names in ``stored`` missing from ``referenced``.
+
+    Both must be sorted.
+    """
+
+    referenced = iter(referenced)
+    current = next(referenced, None)
+
+    for name in stored:
+        while current is not None and current < name:
+            current = next(referenced, None)
+        if name != current:
+            yield name
+
+
+def iter_referenced_names():
+    """Yields the name of every file referenced by any model's file
+    fields, including every thumbnail name.
+
+    Fields on other storages are included too; extra names can only
+    keep files from being deleted.
+    """
+
+    for model in get_models():
+        for field in model._meta.fields:
+            if not isinstance(field, FileField):
+                continue
+
+            objects = (model._base_manager.exclude(**{field.name: ''})
+                       .exclude(**{'%s__isnull' % field.name: True})
+                       .only(model._meta.pk.name, field.name))
+
+            for obj in objects.iterator():
+                field_file = getattr(obj, field.name)
+                if not (isinstance(field_file, FieldFile) and
+                        field_file.field is field and field_file.name):
+                    continue
+
+                yield force_text(field_file.name)
+
+                if hasattr(field, 'get_thumbnail_filenames'):
+                    for name in field.get_thumbnail_filenames(obj,
+                                                              field_file):
+                        yield force_text(name)
+
+
+class Command(BaseCommand):
+    option_list = BaseCommand.option_list + (
+        make_option('-c', '--contenttype',
+            dest='content_type', action='store',
+            help='Content type of thumbnail field.'),
+        make_option('-f', '--fieldname',
+            dest='field_name', action='store',
+            help='Field name of thumbnail field.'),
+        make_option('-d', '--directory',
+            dest='directory', action='store',
+            help='Storage directory to sweep. Defaults to upload_to.'),
+        make_option('-n', '--dry-run',
+            dest='dry_run', action='store_true', default=False,
+            help='List orphans without deleting them.'),
+        make_option('-b', '--batch-size',
+            dest='batch_size', action='store', type='int', default=100,
+            help='Number of files deleted per batch.'),
+        make_option('--sleep',
+            dest='sleep', action='store', type='float', default=0,
+            help='Seconds to pause between batches.'),
+        make_option('--min-age',
+            dest='min_age', action='store', type='int', default=60,
+            help='Only delete files older than this many minutes.'),
+        make_option('--chunk-size',
+            dest='chunk_size', action='store', type='int', default=100000,
+            help='Number of names sorted in memory at once.'),
+    )
+    help = ("Deletes sources and thumbnails which are no longer "
+            "referenced from a thumbnail field's storage.")
+
+    def handle(self, *args, **options):
+        content_type_path = options.get('content_type') or ''
+        field_name = options.get('field_name') or ''
+
+        try:
+            app_label, model_name = content_type_path.split('.')
+            model = get_model(app_label, model_name)
+            if model is None:
+                raise ValueError
+        except (ValueError, AttributeError):
+            raise CommandError('Invalid content type %s' % content_type_path)
+
+        try:
+            field = model._meta.get_field_by_name(field_name)[0]
+        except FieldDoesNotExist:
+            raise CommandError('Invalid field name %s' % field_name)
+
+        directory = options.get('directory')
+        if directory is None:
+            if callable(field.upload_to):
+                raise CommandError('Field %s has a callable upload_to, '
+                                   'specify -d or --directory' % field_name)
+            directory = field.upload_to
+        directory = directory.strip('/')
+
+        storage = field.storage
+        chunk_size = options['chunk_size']
+
+        stored = iter_sorted(walk_storage(storage, directory), chunk_size)
+        referenced = iter_sorted(iter_referenced_names(), chunk_size)
+
+        min_age = options['min_age']
+        min_modified = datetime.now() - timedelta(minutes=min_age)
+        count = 0
+        batch = []
+        manifests = {}
+
+        for name in iter_orphans(stored, referenced):
+            # leave recent files alone, their rows may not be committed yet
+            if min_age and storage.modified_time(name) > min_modified:
+                continue
+
+            # live sprite sheets and manifests belong to no row
+            if is_sprite_file(storage, name, manifests):
+                continue
+
+            count += 1
+            batch.append(name)
+            if len(batch) >= options['batch_size']:
+                self.delete_batch(storage, batch, options)
+                batch = []
+
+        if batch:
+            self.delete_batch(storage, batch, options)
+
+        self.stdout.write('%s %d orphaned files.\n' % (
+            'Found' if options['dry_run'] else 'Deleted', count))
+
+    def delete_batch(self, storage, batch, options):
+        for name in batch:
+            self.stdout.write('%s %s ...\n' % (
+                'Orphaned' if options['dry_run'] else 'Deleting', name))
+            if not options['dry_run']:
+                storage.delete(name)
+
+        if options['sleep'] and not options['dry_run']:
+            time.sleep(options['sleep'])
@@ -0,0 +1,51 @@
+from django.db import models
+from django.db.models.query import QuerySet
+
+from undermythumb.fields import get_fallback_relations
+
+
+__all__ = ('FallbackQuerySet', 'FallbackManager')
+
+
+class FallbackQuerySet(QuerySet):
+
+    def select_fallbacks(self, only=False):
+        """Follows every relation crossed by the model's fallback paths
+        with ``select_related``, so resolving fallbacks costs no queries
+        per row.
+
+        With ``only``, related models load just their primary key and
+        the fields fallbacks read.
+        """
+
+        relations = get_fallback_relations(self.model)
+        if not relations:
+            return self._clone()
+
+        queryset = self.select_related(*relations.keys())
+
+        if only:
+            deferred = []
+            for lookup, (model, field_names) in relations.items():
+                deferred.extend(
+                    '%s__%s' % (lookup, field.name)
+                    for field in model._meta.concrete_fields
+                    if not (field.primary_key or field.name in field_names))
+            queryset = queryset.defer(*deferred)
+
+        return queryset
+
+
+class FallbackManager(models.Manager):
+    """A manager whose querysets can plan fallback relations.
+
+    Example: ::
+
+        articles = Article.objects.select_fallbacks()
+    """
+
+    def get_queryset(self):
+        return FallbackQuerySet(self.model, using=self._db)
+
+    def select_fallbacks(self, only=False):
+        return self.get_queryset().select_fallbacks(only=only)
@@ -0,0 +1,224 @@
+from collections import OrderedDict
+import os
+import threading
+
+from django.conf import settings
+
+from undermythumb.pipeline import Crop, Operation, PipelineRenderer, Resize
+
+
+__all__ = ('Overlay', 'OverlayRenderer', 'get_overlay', 'clear_overlays')
+
+
+POSITIONS = ('top-left', 'top-right', 'bottom-left', 'bottom-right',
+             'center')
+
+_assets = {}
+_overlays = OrderedDict()
+_lock = threading.Lock()
+
+
+def find_asset(asset):
+    """Returns the path of ``asset``, which is either absolute, or found
+    by the static files finders.
+    """
+
+    if os.path.isabs(asset):
+        return asset
+
+    from django.contrib.staticfiles import finders
+    return finders.find(asset) or asset
+
+
+def get_asset(asset):
+    """Returns ``asset``, decoded and premultiplied. Each asset is read
+    once per process.
+    """
+
+    from PIL import Image
+
+    with _lock:
+        try:
+            return _assets[asset]
+        except KeyError:
+            pass
+
+    # loaded unlocked; threads racing on a new asset keep the first
+    image = Image.open(find_asset(asset)).convert('RGBA').convert('RGBa')
+    with _lock:
+        return _assets.setdefault(asset, image)
+
+
+def get_overlay(asset, size, opacity=1.):
+    """Returns ``asset`` scaled to ``size``, with ``opacity`` applied, as
+    a ``(color, alpha, inverse)`` tuple: the premultiplied RGB bands,
+    the alpha band, and its inverse, in RGB.
+
+    Scaled overlays are kept in a process-wide LRU cache, of
+    ``UNDERMYTHUMB_OVERLAY_CACHE_SIZE`` entries, 32 by default.
+    """
+
+    from PIL import Image, ImageChops
+
+    key = (asset, tuple(size), opacity)
+    with _lock:
+        try:
+            overlay = _overlays.pop(key)
+            _overlays[key] = overlay
+            return overlay
+        except KeyError:
+            pass
+
+    image = get_asset(asset)
+    if image.size != tuple(size):
+        # premultiplied pixels resample without dark fringes
+        image = image.resize(size, Image.ANTIALIAS)
+
+    bands = image.split()
+    if opacity < 1:
+        table = [int(round(value * opacity)) for value in range(256)]
+        bands = [band.point(table) for band in bands]
+
+    alpha = bands[3]
+    inverse = ImageChops.invert(alpha)
+    overlay = (Image.merge('RGB', bands[:3]), alpha,
+               Image.merge('RGB', (inverse, ) * 3))
+
+    cache_size = getattr(settings, 'UNDERMYTHUMB_OVERLAY_CACHE_SIZE', 32)
+    with _lock:
+        _overlays[key] = overlay
+        while len(_overlays) > cache_size:
+            _overlays.popitem(last=False)
+
+    return overlay
+
+
+def clear_overlays():
+    """Forgets every loaded asset and scaled overlay."""
+
+    with _lock:
+        _assets.clear()
+        _overlays.clear()
+
+
+class Overlay(Operation):
+    """Composites an image ``asset``, such as a watermark, onto the
+    thumbnail.
+
+    The overlay is scaled to ``scale`` times the thumbnail's width,
+    keeping its aspect ratio, or left at its own size when ``scale``
+    is ``None``. It is placed at ``position``, one of ``POSITIONS``,
+    ``margin`` times the thumbnail's shorter side from its edges.
+    """
+
+    in_place = True
+
+    def __init__(self, asset, position='bottom-right', scale=0.25,
+                 opacity=1., margin=0.02):
+        if position not in POSITIONS:
+            raise ValueError('position must be one of %s, not %r' %
+                             (', '.join(POSITIONS), position))
+
+        super(Overlay, self).__init__(asset, position=position, scale=scale,
+                                      opacity=opacity, margin=margin)
+        self.asset = asset
+        self.position = position
+        self.scale = scale
+        self.opacity = float(opacity)
+        self.margin = margin
+
+    def get_box(self, size):
+        """Returns the ``(left, top, right, bottom)`` box the overlay
+        covers on a thumbnail of ``size``.
+        """
+
+        width, height = get_asset(self.asset).size
+        if self.scale is not None:
+            scale = self.scale * size[0] / float(width)
+            width = int(round(width * scale))
+            height = int(round(height * scale))
+
+        # overlays never outgrow the thumbnail
+        if width > size[0] or height > size[1]:
+            scale = min(size[0] / float(width), size[1] / float(height))
+            width, height = int(width * scale), int(height * scale)
+        width, height = max(width, 1), max(height, 1)
+
+        margin = int(round(self.margin * min(size)))
+        vertical, _, horizontal = self.position.partition('-')
+        if self.position == 'center':
+            left = (size[0] - width) // 2
+            top = (size[1] - height) // 2
+        else:
+            left = (margin if horizontal == 'left' else
+                    size[0] - width - margin)
+            top = margin if vertical == 'top' else size[1] - height - margin
+        left = min(max(left, 0), size[0] - width)
+        top = min(max(top, 0), size[1] - height)
+
+        return (left, top, left + width, top + height)
+
+    def apply(self, image):
+        from PIL import ImageChops
+
+        if image.mode not in ('L', 'RGB', 'RGBA'):
+            image = image.convert('RGB')
+
+        box = self.get_box(image.size)
+        color, alpha, inverse = get_overlay(
+            self.asset, (box[2] - box[0], box[3] - box[1]), self.opacity)
+
+        # out = overlay + image * (1 - alpha), as the overlay is
+        # premultiplied
+        region = image.crop(box)
+        if image.mode == 'L':
+            composite = ImageChops.add(
+                ImageChops.multiply(region, inverse.split()[0]),
+                color.convert('L'))
+        else:
+            composite = ImageChops.add(
+                ImageChops.multiply(region.convert('RGB'), inverse), color)
+            if image.mode == 'RGBA':
+                composite.putalpha(ImageChops.add(
+                    ImageChops.multiply(region.split()[3],
+                                        inverse.split()[0]), alpha))
+
+        image.paste(composite, box)
+        return image
+
+
+class OverlayRenderer(PipelineRenderer):
+    """Renders an image cropped, or with ``crop=False`` resized, to a
+    given width and height, then composites an overlay onto it.
+
+    The overlay is applied to the thumbnail, not the source, and its
+    asset is read once per process, and scaled once per size. Options
+    are those of ``Overlay``.
+
+    Example: ::
+
+        OverlayRenderer(300, 200, 'img/watermark.png', opacity=0.5)
+    """
+
+    def __init__(self, width, height, asset, crop=True,
+                 position='bottom-right', scale=0.25, opacity=1.,
+                 margin=0.02, *args, **kwargs):
+        self.width = int(width)
+        self.height = int(height)
+        self.asset = asset
+        self.crop = crop
+        self.overlay = Overlay(asset, position, scale, opacity, margin)
+
+        geometry = (Crop(width, height) if crop else Resize(width, height))
+        super(OverlayRenderer, self).__init__([geometry, self.overlay],
+                                              *args, **kwargs)
+
+    def deconstruct(self):
+        path,args,kwargs = super(PipelineRenderer,self).deconstruct()
+        args = (self.width, self.height, self.asset) + args
+        kwargs.update(self.overlay.deconstruct()[2])
+        kwargs.update({
+            'crop':self.crop,
+        })
+
+        return path,args,kwargs
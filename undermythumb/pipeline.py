@@ -0,0 +1,286 @@
+import struct
+
+from undermythumb.renderers import BaseRenderer, CropRenderer, ResizeRenderer
+
+
+__all__ = ('Operation', 'Crop', 'Resize', 'Sharpen', 'Pad', 'Border',
+           'PipelineRenderer', 'fuse_geometry')
+
+
+def parse_color(color):
+    """Converts a ``'#rrggbb'`` hex string to an RGBA tuple."""
+
+    if isinstance(color, basestring):
+        color = struct.unpack('BBB', color.strip('#').decode('hex')) + (255, )
+    return tuple(color)
+
+
+class Operation(object):
+    """A step of a ``PipelineRenderer``.
+
+    Geometry operations describe a region and an output size, through
+    ``get_transform``, and are never applied on their own; adjacent
+    ones are fused into a single resample. Other operations transform
+    pixels in ``apply``, in place when ``in_place`` is set.
+    """
+
+    is_geometry = False
+
+    # operations which modify, and return, the image they are given
+    in_place = False
+
+    def __init__(self, *args, **kwargs):
+        self._constructor_args = (args, kwargs)
+
+    def __eq__(self, other):
+        return (isinstance(other, Operation) and
+                self.deconstruct() == other.deconstruct())
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        args, kwargs = self.deconstruct()[1:]
+        return '%s(%s)' % (self.__class__.__name__, ', '.join(
+            [repr(arg) for arg in args] +
+            ['%s=%r' % item for item in sorted(kwargs.items())]))
+
+    def deconstruct(self):
+        path = '%s.%s' % (self.__class__.__module__, self.__class__.__name__)
+        args, kwargs = self._constructor_args
+        return path, args, dict(kwargs)
+
+    def get_transform(self, size, focal_point=None):
+        """Returns the ``(left, top, right, bottom)`` box of an image of
+        ``size`` this step keeps, and the size it scales it to.
+        """
+
+        raise NotImplementedError
+
+    def get_output_size(self, size):
+        """Returns the size of this step's output, for an input of
+        ``size``, which may be ``None`` when unknown.
+        """
+
+        return size
+
+    def apply(self, image):
+        raise NotImplementedError
+
+
+class Crop(Operation):
+    """Crops to ``width`` and ``height``, as ``CropRenderer`` does."""
+
+    is_geometry = True
+
+    def __init__(self, width, height, bleed=0.):
+        super(Crop, self).__init__(width, height, bleed=bleed)
+        self.renderer = CropRenderer(width, height, bleed)
+
+    def get_transform(self, size, focal_point=None):
+        return (self.renderer.get_crop_box(size, focal_point),
+                self.renderer.get_output_size(size))
+
+    def get_output_size(self, size):
+        return self.renderer.get_output_size(size)
+
+
+class Resize(Operation):
+    """Resizes to ``width`` and ``height``, as ``ResizeRenderer``
+    does.
+    """
+
+    is_geometry = True
+
+    def __init__(self, width, height, constrain=True, upscale=False):
+        super(Resize, self).__init__(width, height, constrain=constrain,
+                                     upscale=upscale)
+        self.renderer = ResizeRenderer(width, height, constrain, upscale)
+
+    def get_transform(self, size, focal_point=None):
+        return (0, 0) + tuple(size), self.renderer.get_output_size(size)
+
+    def get_output_size(self, size):
+        return self.renderer.get_output_size(size)
+
+
+class Sharpen(Operation):
+    """Applies an unsharp mask."""
+
+    def __init__(self, radius=2, percent=150, threshold=3):
+        super(Sharpen, self).__init__(radius=radius, percent=percent,
+                                      threshold=threshold)
+        self.radius = radius
+        self.percent = percent
+        self.threshold = threshold
+
+    def apply(self, image):
+        from PIL import ImageFilter
+
+        return image.filter(ImageFilter.UnsharpMask(
+            self.radius, self.percent, self.threshold))
+
+
+class Pad(Operation):
+    """Centers the image on a ``width`` by ``height`` canvas."""
+
+    def __init__(self, width, height, bg_color='#FFFFFF'):
+        super(Pad, self).__init__(width, height, bg_color=bg_color)
+        self.size = (width, height)
+        self.bg_color = parse_color(bg_color)
+
+    def get_output_size(self, size):
+        return self.size
+
+    def apply(self, image):
+        from PIL import Image
+
+        canvas = Image.new('RGBA', self.size, self.bg_color)
+        canvas.paste(image, ((self.size[0] - image.size[0]) / 2,
+                             (self.size[1] - image.size[1]) / 2))
+        return canvas
+
+
+class Border(Operation):
+    """Draws a ``width`` pixel border inside the image's edges."""
+
+    in_place = True
+
+    def __init__(self, width=1, color='#000000'):
+        super(Border, self).__init__(width=width, color=color)
+        self.width = width
+        self.color = parse_color(color)
+
+    def apply(self, image):
+        from PIL import ImageDraw
+
+        draw = ImageDraw.Draw(image)
+        right, bottom = image.size[0] - 1, image.size[1] - 1
+        for i in range(min(self.width, (min(image.size) + 1) // 2)):
+            draw.rectangle((i, i, right - i, bottom - i),
+                           outline=self.color[:len(image.getbands())])
+        return image
+
+
+def fuse_geometry(steps, size, focal_point=None):
+    """Composes geometry ``steps`` on an image of ``size`` into a single
+    source box, in fractional pixels, and output size.
+
+    The focal point, if any, follows each step's box.
+    """
+
+    left, top = 0., 0.
+    scale_x = scale_y = 1.
+
+    for step in steps:
+        (box_left, box_top, box_right, box_bottom), output_size = (
+            step.get_transform(size, focal_point))
+
+        if focal_point is not None:
+            focal_point = tuple(
+                min(max((focus * dim - start) / float(end - start), 0.), 1.)
+                for focus, dim, start, end in zip(
+                    focal_point, size, (box_left, box_top),
+                    (box_right, box_bottom)))
+
+        left += box_left * scale_x
+        top += box_top * scale_y
+        scale_x *= float(box_right - box_left) / output_size[0]
+        scale_y *= float(box_bottom - box_top) / output_size[1]
+        size = output_size
+
+    return ((left, top, left + size[0] * scale_x, top + size[1] * scale_y),
+            tuple(size))
+
+
+class PipelineRenderer(BaseRenderer):
+    """Renders an image through a sequence of operations.
+
+    Runs of adjacent geometry operations, such as ``Crop`` and
+    ``Resize``, are fused into one resample of the source. Other
+    operations then work on that output, in place where they can.
+    The source itself is never modified.
+
+    Example: ::
+
+        PipelineRenderer([Crop(300, 300), Resize(150, 150), Sharpen(),
+                          Border(2, '#000000')])
+
+    A focal point moves the crop of a leading geometry run. Pixel
+    operations work on PIL images.
+    """
+
+    uses_focal_point = True
+    native_color = True
+
+    def __init__(self, steps, *args, **kwargs):
+        self.steps = tuple(steps)
+        super(PipelineRenderer, self).__init__(*args, **kwargs)
+
+        # group steps into runs of geometry and pixel operations
+        self.runs = []
+        for step in self.steps:
+            if self.runs and self.runs[-1][0] == step.is_geometry:
+                self.runs[-1][1].append(step)
+            else:
+                self.runs.append((step.is_geometry, [step]))
+
+    def __eq__(self, other):
+        """ Version management for migrations.
+        """
+        return (isinstance(other, PipelineRenderer) and
+                self.steps == other.steps)
+
+    def deconstruct(self):
+        path,args,kwargs = super(PipelineRenderer,self).deconstruct()
+        args = (list(self.steps), ) + args
+
+        return path,args,kwargs
+
+    def get_geometry(self, size, focal_point=None, **options):
+        if not self.runs or not self.runs[0][0]:
+            return None
+        return fuse_geometry(self.runs[0][1], size, focal_point)
+
+    def get_load_size(self, size, **options):
+        geometry = self.get_geometry(size)
+        if geometry is None:
+            return None
+
+        (left, top, right, bottom), (width, height) = geometry
+        scale = max(width / (right - left), height / (bottom - top))
+        if scale >= 1:
+            return None
+        return (int(size[0] * scale) + 1, int(size[1] * scale) + 1)
+
+    def get_output_size(self, size=None):
+        for step in self.steps:
+            size = step.get_output_size(size)
+        return size
+
+    def _render(self, image, focal_point=None, geometry=None, **options):
+        backend = self.backend
+        owned = converted = False
+
+        for index, (is_geometry, steps) in enumerate(self.runs):
+            if is_geometry:
+                if index or geometry is None:
+                    geometry = fuse_geometry(
+                        steps, backend.get_size(image),
+                        None if index else focal_point)
+                box, size = geometry
+                image = backend.fit(image, size, box)
+                owned = True
+                continue
+
+            if not converted:
+                image = self._convert_color(image)
+                converted = True
+
+            for step in steps:
+                if step.in_place and not owned:
+                    image = image.copy()
+                image = step.apply(image)
+                owned = True
+
+        return image
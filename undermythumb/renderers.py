@@ -1,23 +1,148 @@
+import base64
+import math
 import struct
 
 from cStringIO import StringIO
 
 from django.core.files.base import ContentFile
 
-from PIL import Image, ImageOps
+from undermythumb.backends import get_backend
+from undermythumb.scheduler import get_render_pool, get_render_scheduler
+from undermythumb.testing import stub_render, stub_renders_enabled
+
+# PIL is imported on first use, so defining fields, naming thumbnails
+# and running migrations never load it.
+
+
+# output formats which can hold more than one frame
+ANIMATED_FORMATS = ('GIF', 'WEBP')
+
+# modes which can be downscaled before being converted to RGB
+NATIVE_MODES = ('L', 'RGB', 'RGBA', 'CMYK', 'YCbCr')
+
+# longest side of inline placeholder previews
+PLACEHOLDER_SIZE = 16
+
+# output formats whose size depends on ``quality``
+QUALITY_FORMATS = ('JPEG', 'WEBP')
+
+# encoded size of typical photographs at each quality, relative to
+# quality 90, from highest to lowest quality
+QUALITY_SIZES = ((95, 1.42), (90, 1.), (85, .82), (80, .68), (75, .61),
+                 (70, .55), (60, .46), (50, .4), (40, .35), (30, .3),
+                 (20, .24), (10, .16))
+
+
+def find_focal_point(content, sample_size=64):
+    """Guesses an image's focal point from a small, downscaled copy.
+
+    Edges are found on a grayscale copy no larger than ``sample_size``
+    on its longest side, and their center of mass is returned as an
+    ``(x, y)`` tuple of fractions of the image's width and height.
+    JPEG sources are decoded in draft mode, so the full-resolution
+    image is never loaded.
+    """
+
+    if stub_renders_enabled():
+        return (0.5, 0.5)
+
+    from PIL import Image, ImageFilter
+
+    content.seek(0)
+    image = Image.open(content)
+    image.draft('L', (sample_size, sample_size))
+    image = image.convert('L')
+    image.thumbnail((sample_size, sample_size), Image.ANTIALIAS)
+
+    # drop the outermost pixels, which always register as edges
+    edges = image.filter(ImageFilter.FIND_EDGES)
+    width, height = edges.size
+    if width > 2 and height > 2:
+        edges = edges.crop((1, 1, width - 1, height - 1))
+        width, height = edges.size
+
+    total = x_total = y_total = 0
+    for i, value in enumerate(edges.getdata()):
+        total += value
+        x_total += (i % width) * value
+        y_total += (i // width) * value
+
+    if not total:
+        return (0.5, 0.5)
+
+    return ((x_total / float(total) + 0.5) / width,
+            (y_total / float(total) + 0.5) / height)
+
+
+def get_image_metadata(image, placeholder_size=PLACEHOLDER_SIZE):
+    """Returns a dict holding an image's average ``color``, as a hex
+    string, and a tiny blurred JPEG ``placeholder``, as a data URI
+    suitable for inlining.
+    """
+
+    from PIL import Image, ImageFilter
+
+    preview = image.copy()
+    preview.thumbnail((placeholder_size, placeholder_size), Image.ANTIALIAS)
+    if preview.mode != 'RGB':
+        preview = preview.convert('RGB')
+
+    color = preview.resize((1, 1), Image.ANTIALIAS).getpixel((0, 0))
+
+    io = StringIO()
+    preview = preview.filter(ImageFilter.GaussianBlur(1))
+    preview.save(io, 'JPEG', quality=40)
+
+    return {
+        'color': '#%02x%02x%02x' % color,
+        'placeholder': ('data:image/jpeg;base64,%s' %
+                        base64.b64encode(io.getvalue())),
+    }
 
 
 class BaseRenderer(object):
     """Base class for renderers.
 
     Subclass this to build your own renderers.
+
+    By default only the first frame of a source is read. With
+    ``animated``, renderers writing GIF or WebP keep up to
+    ``max_frames`` frames, taking every ``frame_step``-th frame and
+    stretching its duration to cover those skipped.
+
+    With ``max_bytes``, JPEG and WebP output is encoded at the highest
+    quality, up to ``quality``, which fits in that many bytes. At most
+    ``max_attempts`` encodes are tried, starting from a quality
+    predicted from the source's size, and the quality chosen is kept
+    in the render's metadata, as the first guess for the next render.
+    Animated output is exempt.
+
+    Pixels are handled by an imaging ``backend``, named as registered
+    with ``undermythumb.backends.register_backend``. Custom renderers
+    receive and return the backend's images, PIL images by default.
     """
 
+    # renderers which honour a per-instance focal point receive it
+    # as the ``focal_point`` keyword of ``_render``
+    uses_focal_point = False
+
+    # renderers which can work on any of ``NATIVE_MODES`` are handed
+    # the source unconverted, and their output is converted to RGB
+    native_color = False
+
     def __init__(self, format='jpg', quality=100, force_rgb=True,
+                 animated=False, max_frames=None, frame_step=1,
+                 max_bytes=None, max_attempts=6, backend=None,
                  *args, **kwargs):
         self.format = format
         self.quality = quality
         self.force_rgb = force_rgb
+        self.animated = animated
+        self.max_frames = max_frames
+        self.frame_step = max(int(frame_step), 1)
+        self.max_bytes = max_bytes
+        self.max_attempts = max(int(max_attempts), 1)
+        self.backend_name = backend
         self.options = kwargs
 
         self._constructor_args = (args, kwargs)
@@ -30,9 +155,26 @@ class BaseRenderer(object):
             'quality':self.quality,
             'force_rgb':self.force_rgb,
         })
+        if self.animated:
+            kwargs.update({
+                'animated':self.animated,
+                'max_frames':self.max_frames,
+                'frame_step':self.frame_step,
+            })
+        if self.max_bytes:
+            kwargs.update({
+                'max_bytes':self.max_bytes,
+                'max_attempts':self.max_attempts,
+            })
+        if self.backend_name is not None:
+            kwargs['backend'] = self.backend_name
 
         return path,args,kwargs
 
+    @property
+    def backend(self):
+        return get_backend(self.backend_name)
+
     def _normalize_format(self):
         format = self.format.upper()
         if format in ['JPG']:
@@ -42,31 +184,284 @@ class BaseRenderer(object):
     def _create_tmp_image(self, content):
         """Creates a temporary image for manipulation, and handles
         optional RGB conversion.
+
+        Sources are decoded at the smallest scale ``get_load_size``
+        allows, where the format supports it.
+        """
+
+        backend = self.backend
+        image = backend.open(content)
+
+        load_size = self.get_load_size(backend.get_size(image))
+        if load_size is not None:
+            image = backend.shrink_on_load(image, load_size)
+
+        mode = backend.get_mode(image)
+        if self.native_color and mode in NATIVE_MODES:
+            return image
+        if self.force_rgb and mode not in ('L', 'RGB', 'RGBA'):
+            image = self._convert_color(image)
+        return image
+
+    def _convert_color(self, image):
+        """Converts an image to RGB, through its embedded ICC profile
+        to sRGB when it has one.
         """
 
+        if not self.force_rgb:
+            return image
+        return self.backend.convert_color(image)
+
+    def get_load_size(self, size, **options):
+        """Returns the smallest size a source of ``size`` may be decoded
+        at without loss, or ``None`` to decode it at full size.
+        """
+
+        return None
+
+    def _create_tmp_frames(self, content):
+        """Returns the frames of an animated image, with their durations
+        and loop count.
+
+        Frames past ``max_frames`` are never decoded.
+        """
+
+        from PIL import Image, ImageSequence
+
         content.seek(0)
         image = Image.open(content)
-        if self.force_rgb and image.mode not in ('L', 'RGB', 'RGBA'):
-            image = image.convert('RGB')
-        return image
+        loop = image.info.get('loop', 0)
+
+        frames = []
+        durations = []
+        for index, frame in enumerate(ImageSequence.Iterator(image)):
+            duration = frame.info.get('duration', 100)
+
+            if index % self.frame_step:
+                durations[-1] += duration
+                continue
+
+            frames.append(frame.convert('RGBA'))
+            durations.append(duration)
+            if self.max_frames and len(frames) >= self.max_frames:
+                # the frames this one would cover are left unread, and
+                # assumed to last as long
+                durations[-1] *= self.frame_step
+                break
 
-    def _create_content_file(self, content):
+        return frames, durations, loop
+
+    def _create_content_file(self, content, metadata=None, source=None):
         """Returns image data as a ``ContentFile``.
         """
 
+        format = self._normalize_format()
+        if not self.max_bytes or format not in QUALITY_FORMATS:
+            return ContentFile(self.backend.encode(content, format,
+                                                   self.quality))
+
+        quality, data = self._encode_to_budget(content, format, metadata,
+                                               source)
+        if metadata is not None:
+            metadata['quality'] = quality
+        return ContentFile(data)
+
+    def _get_source_density(self, content):
+        """Returns the ``(bytes per pixel, pixels)`` of a JPEG or WebP
+        source, from its header, or ``None`` for other formats.
+        """
+
+        size = getattr(content, 'size', None)
+        image = self.backend.open(content)
+        if not size or getattr(image, 'format', None) not in QUALITY_FORMATS:
+            return None
+
+        width, height = self.backend.get_size(image)
+        return size / float(width * height), width * height
+
+    def predict_quality(self, source, size):
+        """Predicts the highest quality at which an image of ``size``,
+        rendered from a source of ``(bytes per pixel, pixels)``, fits
+        in ``max_bytes``.
+
+        Sources are assumed to be encoded at about quality 90, and
+        downscaling to pack more detail into each pixel.
+        """
+
+        bytes_per_pixel, source_pixels = source
+        pixels = size[0] * size[1]
+        expected = bytes_per_pixel * (float(source_pixels) / pixels) ** 0.3
+        budget = self.max_bytes / float(pixels)
+
+        for quality, relative_size in QUALITY_SIZES:
+            if quality <= self.quality and expected * relative_size <= budget:
+                return quality
+        return QUALITY_SIZES[-1][0]
+
+    def _encode_to_budget(self, image, format, metadata=None, source=None):
+        """Bisects for the highest quality at which ``image`` encodes
+        to no more than ``max_bytes``, starting from the quality
+        recorded in ``metadata``, if any, or else one predicted from
+        the ``source``'s density.
+
+        Returns the quality and encoded data. When nothing tried fits,
+        the smallest encode is returned.
+        """
+
+        low, high = 1, self.quality
+        guess = high
+        if metadata and metadata.get('quality'):
+            guess = min(max(int(metadata['quality']), low), high)
+        elif source is not None:
+            guess = self.predict_quality(source, self.backend.get_size(image))
+
+        best = smallest = None
+        for attempt in range(self.max_attempts):
+            data = self.backend.encode(image, format, guess)
+            if len(data) <= self.max_bytes:
+                best = (guess, data)
+                low = guess + 1
+            else:
+                if smallest is None or guess < smallest[0]:
+                    smallest = (guess, data)
+                high = guess - 1
+
+            if low > high:
+                break
+            guess = (low + high + 1) // 2
+
+        return best or smallest
+
+    def _create_animated_content_file(self, frames, durations, loop):
+        """Returns animated image data as a ``ContentFile``.
+
+        Animations are exempt from ``max_bytes``, and always encoded
+        at ``quality``.
+        """
+
+        # GIF sources leave a palette index as the frames' background,
+        # which WebP can't use
+        frames[0].info.pop('background', None)
+
         io = StringIO()
-        content.save(io, self._normalize_format(), quality=self.quality)
+        frames[0].save(io, self._normalize_format(), quality=self.quality,
+                       save_all=True, append_images=frames[1:],
+                       duration=durations, loop=loop)
         return ContentFile(io.getvalue())
 
-    def generate(self, content):
+    def estimate_cost(self, content):
+        """Estimates the memory, in bytes, needed to render ``content``,
+        from its header alone.
+
+        PIL holds single-band images in a byte per pixel, and everything
+        else in four. A decoded source is assumed to be copied once,
+        by conversion or cropping, while it is rendered.
+        """
+
+        from PIL import Image
+
+        content.seek(0)
+        image = Image.open(content)
+        width, height = image.size
+        frames = 1
+
+        if self.animated and self._normalize_format() in ANIMATED_FORMATS:
+            frames = getattr(image, 'n_frames', 1)
+            if self.max_frames:
+                frames = min(frames, self.max_frames)
+
+        pixel_size = 1 if image.mode in ('1', 'L', 'P') else 4
+        return width * height * pixel_size * 2 * frames
+
+    def generate(self, content, metadata=None, describe=True, **options):
         """Resizes a valid image, and returns as a Django ``ContentFile``.
+
+        When given a ``metadata`` dict, it is filled with the quality a
+        byte-budget encode settles on and, unless ``describe`` is false,
+        the rendered image's average color and inline placeholder.
+
+        With a render budget configured, the render waits its turn
+        for memory with the process-wide ``RenderScheduler``. With
+        ``UNDERMYTHUMB_STUB_RENDERS``, nothing is rendered at all; see
+        ``undermythumb.testing``.
+
+        Extra ``options`` are handed to ``_render``.
+        """
+
+        if stub_renders_enabled():
+            return stub_render(self, metadata, describe, **options)
+
+        scheduler = get_render_scheduler()
+        if scheduler is None:
+            return self._generate(content, metadata, describe, **options)
+
+        with scheduler.reserve(self.estimate_cost(content)):
+            return self._generate(content, metadata, describe, **options)
+
+    def generate_async(self, content, metadata=None, describe=True,
+                       **options):
+        """Like ``generate``, but renders on the render pool.
+
+        Returns an ``AsyncResult``, whose ``get`` returns the
+        ``ContentFile``. ``content`` must not be read by anything else
+        until then.
         """
 
+        return get_render_pool().apply_async(
+            self.generate, (content, metadata, describe), options)
+
+    def _generate(self, content, metadata=None, describe=True, **options):
+        if (self.animated and self.backend.supports_animation and
+                self._normalize_format() in ANIMATED_FORMATS):
+            frames, durations, loop = self._create_tmp_frames(content)
+            if len(frames) > 1:
+                rendered = self._render_frames(frames, **options)
+                if metadata is not None and describe:
+                    metadata.update(get_image_metadata(rendered[0]))
+                return self._create_animated_content_file(rendered,
+                                                          durations, loop)
+
+        source = None
+        if (self.max_bytes and self._normalize_format() in QUALITY_FORMATS
+                and not (metadata and metadata.get('quality'))):
+            source = self._get_source_density(content)
+
         tmp = self._create_tmp_image(content)
-        rendered = self._render(tmp)
-        return self._create_content_file(rendered)
+        rendered = self._render(tmp, **options)
+        if self.native_color:
+            rendered = self._convert_color(rendered)
+        if metadata is not None and describe:
+            metadata.update(get_image_metadata(self.backend.to_pil(rendered)))
+        return self._create_content_file(rendered, metadata, source)
+
+    def get_geometry(self, size, **options):
+        """Returns what ``_render`` needs to know about an image of
+        ``size``, such as a crop box or target size.
+
+        Geometry is computed once per source, and handed to ``_render``
+        for every frame as ``geometry``. Renderers returning ``None``
+        never receive it.
+        """
+
+        return None
 
-    def _render(self, image):
+    def get_output_size(self, size=None):
+        """Returns the ``(width, height)`` of this renderer's output for
+        a source of ``size``, or ``None`` if it can't be known without
+        rendering. ``size`` may be ``None`` when the source's size is
+        unknown.
+        """
+
+        return None
+
+    def _render_frames(self, frames, **options):
+        geometry = self.get_geometry(frames[0].size, **options)
+        if geometry is not None:
+            options['geometry'] = geometry
+
+        return [self._render(frame, **options) for frame in frames]
+
+    def _render(self, image, **options):
         """Renders the image. Override this method when creating
         a custom renderer.
         """
@@ -76,8 +471,14 @@ class BaseRenderer(object):
 
 class CropRenderer(BaseRenderer):
     """Renders an image cropped to a given width and height.
+
+    The crop is centered on the image, or on a ``focal_point``
+    given as an ``(x, y)`` tuple of fractions of the image's size.
     """
 
+    uses_focal_point = True
+    native_color = True
+
     def __init__(self, width, height, bleed=0., *args, **kwargs):
         self.width = int(width)
         self.height = int(height)
@@ -102,9 +503,73 @@ class CropRenderer(BaseRenderer):
 
         return path,args,kwargs
 
-    def _render(self, image):
-        return ImageOps.fit(image, (self.width, self.height),
-                            Image.ANTIALIAS, self.bleed, (0.5, 0.5))
+    def _get_centering(self, size, focal_point=None):
+        """Converts a focal point into the crop's centering for
+        an image of ``size``, keeping the focal point as close to the
+        middle of the crop as the image's edges allow.
+        """
+
+        if focal_point is None:
+            return (0.5, 0.5)
+
+        centering = []
+        live_size = [dim * (1 - 2 * self.bleed) for dim in size]
+        crop_size = self._get_crop_size(live_size)
+
+        for live, crop, focus in zip(live_size, crop_size, focal_point):
+            slack = live - crop
+            if slack <= 0:
+                centering.append(0.5)
+                continue
+            offset = focus * live - crop / 2.
+            centering.append(min(max(offset / slack, 0.), 1.))
+
+        return tuple(centering)
+
+    def _get_crop_size(self, live_size):
+        live_ratio = float(live_size[0]) / live_size[1]
+        output_ratio = float(self.width) / self.height
+
+        if live_ratio >= output_ratio:
+            return (output_ratio * live_size[1], live_size[1])
+        return (live_size[0], live_size[0] / output_ratio)
+
+    def get_crop_box(self, size, focal_point=None):
+        """Returns the ``(left, top, right, bottom)`` region of an image
+        of ``size`` which this renderer keeps.
+        """
+
+        bleed = (self.bleed * size[0], self.bleed * size[1])
+        live_size = (size[0] - bleed[0] * 2, size[1] - bleed[1] * 2)
+        crop_width, crop_height = self._get_crop_size(live_size)
+        centering = self._get_centering(size, focal_point)
+
+        left = bleed[0] + (live_size[0] - crop_width) * centering[0]
+        top = bleed[1] + (live_size[1] - crop_height) * centering[1]
+
+        return tuple(int(round(value)) for value in
+                     (left, top, left + crop_width, top + crop_height))
+
+    def get_geometry(self, size, focal_point=None, **options):
+        return self.get_crop_box(size, focal_point)
+
+    def get_output_size(self, size=None):
+        return (self.width, self.height)
+
+    def get_load_size(self, size, **options):
+        left, top, right, bottom = self.get_crop_box(size)
+        scale = max(float(self.width) / (right - left),
+                    float(self.height) / (bottom - top))
+        if scale >= 1:
+            return None
+        return (int(math.ceil(size[0] * scale)),
+                int(math.ceil(size[1] * scale)))
+
+    def _render(self, image, focal_point=None, geometry=None, **options):
+        backend = self.backend
+        box = geometry or self.get_geometry(backend.get_size(image),
+                                            focal_point)
+        return backend.fit(image, (self.width, self.height), box)
 
 
 class ResizeRenderer(BaseRenderer):
@@ -115,6 +580,8 @@ class ResizeRenderer(BaseRenderer):
     ``upscale`` is ``True``.
     """
 
+    native_color = True
+
     def __init__(self, width, height, constrain=True, upscale=False,
                  *args, **kwargs):
         self.width = width
@@ -144,9 +611,9 @@ class ResizeRenderer(BaseRenderer):
 
         return path,args,kwargs
 
-    def _render(self, image):
+    def get_geometry(self, size, **options):
         dst_width, dst_height = float(self.width), float(self.height)
-        src_width, src_height = map(float, image.size)
+        src_width, src_height = map(float, size)
 
         if self.constrain:
             scale = min(dst_width / src_width, dst_height / src_height)
@@ -159,13 +626,27 @@ class ResizeRenderer(BaseRenderer):
             height = dst_height
             if not self.upscale:
                 width = min(width, src_width)
-                hidth = min(width, src_height)
+                height = min(height, src_height)
             width = int(round(width))
             height = int(round(height))
 
-        image = image.resize((width, height), Image.ANTIALIAS)
+        return (width, height)
 
-        return image
+    def get_output_size(self, size=None):
+        if size is None:
+            return None
+        return self.get_geometry(size)
+
+    def get_load_size(self, size, **options):
+        load_size = self.get_geometry(size)
+        if load_size[0] >= size[0] and load_size[1] >= size[1]:
+            return None
+        return load_size
+
+    def _render(self, image, geometry=None, **options):
+        backend = self.backend
+        size = geometry or self.get_geometry(backend.get_size(image))
+        return backend.resize(image, size)
 
 
 class LetterboxRenderer(ResizeRenderer):
@@ -207,14 +688,13 @@ class LetterboxRenderer(ResizeRenderer):
 
         return path,args,kwargs
 
-    def _render(self, image):
-        image = super(LetterboxRenderer, self)._render(image)
-        src_w, src_h = image.size
+    def get_output_size(self, size=None):
+        return (self.width, self.height)
 
-        # place image on canvas and save
-        canvas = Image.new('RGBA', (self.width, self.height), self.bg_color)
-        paste_x = (self.width - src_w) / 2
-        paste_y = (self.height - src_h) / 2
-        canvas.paste(image, (paste_x, paste_y))
+    def _render(self, image, **options):
+        image = super(LetterboxRenderer, self)._render(image, **options)
+        image = self._convert_color(image)
 
-        return canvas
+        # place image on canvas and save
+        return self.backend.pad(image, (self.width, self.height),
+                                self.bg_color)
@@ -0,0 +1,155 @@
+from collections import deque
+from contextlib import contextmanager
+import threading
+import time
+
+from django.conf import settings
+
+
+__all__ = ('RenderScheduler', 'RenderTimeout', 'get_render_scheduler',
+           'get_render_pool')
+
+
+class RenderTimeout(Exception):
+    """Raised when a render waits too long for memory."""
+
+
+class RenderScheduler(object):
+    """Admits render jobs against a process-wide memory budget.
+
+    Jobs are admitted strictly in arrival order, so large jobs are
+    never starved by a stream of small ones. A job costing more than
+    the whole budget runs alone.
+    """
+
+    def __init__(self, budget, timeout=None):
+        self.budget = budget
+        self.timeout = timeout
+
+        self._condition = threading.Condition()
+        self._queue = deque()
+        self._in_use = 0
+
+        self._admitted = 0
+        self._timeouts = 0
+        self._total_wait = 0.
+        self._max_wait = 0.
+
+    def acquire(self, cost, timeout=None):
+        """Blocks until ``cost`` bytes fit in the budget, and reserves
+        them. Raises ``RenderTimeout`` after ``timeout`` seconds.
+
+        Returns the reserved cost, to be given back to ``release``.
+        """
+
+        cost = min(cost, self.budget)
+        ticket = object()
+        start = time.time()
+
+        with self._condition:
+            self._queue.append(ticket)
+
+            while (self._queue[0] is not ticket or
+                   self._in_use + cost > self.budget):
+                remaining = None
+                if timeout is not None:
+                    remaining = start + timeout - time.time()
+                    if remaining <= 0:
+                        self._queue.remove(ticket)
+                        self._timeouts += 1
+                        self._condition.notify_all()
+                        raise RenderTimeout(
+                            'Waited %.1fs for %d bytes of render memory' %
+                            (timeout, cost))
+                self._condition.wait(remaining)
+
+            self._queue.popleft()
+            self._in_use += cost
+
+            wait = time.time() - start
+            self._admitted += 1
+            self._total_wait += wait
+            self._max_wait = max(self._max_wait, wait)
+
+            # the next job in line may fit too
+            self._condition.notify_all()
+
+        return cost
+
+    def release(self, cost):
+        with self._condition:
+            self._in_use -= cost
+            self._condition.notify_all()
+
+    @contextmanager
+    def reserve(self, cost, timeout=None):
+        if timeout is None:
+            timeout = self.timeout
+
+        cost = self.acquire(cost, timeout)
+        try:
+            yield
+        finally:
+            self.release(cost)
+
+    def get_stats(self):
+        """Returns queue depth, memory in use, and wait-time metrics.
+        """
+
+        with self._condition:
+            return {
+                'budget': self.budget,
+                'in_use': self._in_use,
+                'queue_depth': len(self._queue),
+                'admitted': self._admitted,
+                'timeouts': self._timeouts,
+                'total_wait': self._total_wait,
+                'max_wait': self._max_wait,
+                'mean_wait': self._total_wait / (self._admitted or 1),
+            }
+
+
+_scheduler = []
+_scheduler_lock = threading.Lock()
+
+
+def get_render_scheduler():
+    """Returns the process-wide scheduler, or ``None`` when no
+    ``UNDERMYTHUMB_RENDER_BUDGET`` is set.
+
+    ``UNDERMYTHUMB_RENDER_BUDGET`` is a size in bytes, and
+    ``UNDERMYTHUMB_RENDER_TIMEOUT`` an optional wait in seconds.
+    """
+
+    if not _scheduler:
+        with _scheduler_lock:
+            if not _scheduler:
+                budget = getattr(settings, 'UNDERMYTHUMB_RENDER_BUDGET', None)
+                timeout = getattr(settings, 'UNDERMYTHUMB_RENDER_TIMEOUT',
+                                  None)
+                _scheduler.append(budget and RenderScheduler(budget, timeout))
+
+    return _scheduler[0]
+
+
+_pool = []
+_pool_lock = threading.Lock()
+
+
+def get_render_pool():
+    """Returns the process-wide pool of render threads.
+
+    ``UNDERMYTHUMB_RENDER_THREADS`` sets its size, 4 by default. PIL
+    releases the GIL while decoding, resizing and encoding, so renders
+    on the pool run in parallel with each other and with the caller.
+    """
+
+    if not _pool:
+        from multiprocessing.pool import ThreadPool
+
+        with _pool_lock:
+            if not _pool:
+                threads = getattr(settings, 'UNDERMYTHUMB_RENDER_THREADS', 4)
+                _pool.append(ThreadPool(threads))
+
+    return _pool[0]
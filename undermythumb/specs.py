@@ -0,0 +1,93 @@
+from collections import namedtuple
+from hashlib import sha1
+
+from django.core.exceptions import ImproperlyConfigured
+
+
+__all__ = ('ThumbnailSpec', 'compile_thumbnail_specs')
+
+
+def serialize(value):
+    """Returns ``value`` as nested tuples of plain values, following
+    ``deconstruct()`` into nested objects, so its ``repr`` is the same
+    in every process.
+    """
+
+    if hasattr(value, 'deconstruct') and not isinstance(value, type):
+        path, args, kwargs = value.deconstruct()
+        return (path, serialize(args), serialize(kwargs))
+    if isinstance(value, dict):
+        return tuple(sorted((key, serialize(item))
+                            for key, item in value.items()))
+    if isinstance(value, (list, tuple)):
+        return tuple(serialize(item) for item in value)
+    return value
+
+
+class ThumbnailSpec(namedtuple('ThumbnailSpec',
+                               'attname renderer key ext template '
+                               'version')):
+    """An immutable, validated thumbnail definition.
+
+    ``template`` is the thumbnail's filename with a ``%s`` placeholder
+    for the source file's hash, so naming a thumbnail is a single
+    string interpolation. ``version`` is a short digest of the
+    renderer's arguments, which changes whenever its output may.
+    """
+
+    __slots__ = ()
+
+    @classmethod
+    def compile(cls, options):
+        """Builds a spec from a ``(attname, renderer)`` or
+        ``(attname, renderer, key)`` tuple.
+        """
+
+        try:
+            attname, renderer, key = options
+        except ValueError:
+            try:
+                attname, renderer = options
+            except ValueError:
+                raise ImproperlyConfigured(
+                    'Thumbnails must be defined as (name, renderer) or '
+                    '(name, renderer, key) tuples, not %r' % (options, ))
+            key = attname
+        except TypeError:
+            raise ImproperlyConfigured(
+                'Thumbnails must be defined as tuples, not %r' % (options, ))
+
+        if not hasattr(renderer, 'generate'):
+            raise ImproperlyConfigured(
+                'Thumbnail %r has no renderer, got %r' % (attname, renderer))
+
+        ext = '.%s' % renderer.format
+        template = '%s.%%s%s' % (key.replace('%', '%%'),
+                                 ext.replace('%', '%%'))
+
+        version = template
+        if hasattr(renderer, 'deconstruct'):
+            version = repr((template, serialize(renderer)))
+        version = sha1(version).hexdigest()[:8]
+
+        return cls(attname, renderer, key, ext, template, version)
+
+    def get_filename(self, prefix, hash_value):
+        return prefix + self.template % hash_value
+
+
+def compile_thumbnail_specs(thumbnails):
+    """Validates a field's ``thumbnails`` definition once, returning a
+    tuple of ``ThumbnailSpec`` objects.
+    """
+
+    specs = tuple(ThumbnailSpec.compile(options) for options in thumbnails)
+
+    seen = set()
+    for spec in specs:
+        if spec.attname in seen:
+            raise ImproperlyConfigured(
+                'Thumbnail name %r is defined more than once' % spec.attname)
+        seen.add(spec.attname)
+
+    return specs
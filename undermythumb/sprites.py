@@ -0,0 +1,236 @@
+from cStringIO import StringIO
+from hashlib import sha1
+import json
+import posixpath
+import re
+
+from django.core.exceptions import ImproperlyConfigured
+from django.core.files.base import ContentFile
+
+from undermythumb.storage import publish
+
+
+__all__ = ('SpriteSheet', 'is_sprite_file')
+
+
+# sheets are named <name>.<digest>.<format>, beside <name>.json
+SHEET_NAME_RE = re.compile(r'^(.+)\.[0-9a-f]{8}\.\w+$')
+
+
+def read_manifest(storage, name):
+    """Returns the sprite sheet manifest stored as ``name``, or an
+    empty dict if it can't be read.
+    """
+
+    try:
+        manifest_file = storage.open(name)
+        try:
+            manifest = json.loads(manifest_file.read())
+        finally:
+            manifest_file.close()
+    except (IOError, OSError, ValueError):
+        return {}
+    return manifest if isinstance(manifest, dict) else {}
+
+
+def is_sprite_file(storage, name, manifests=None):
+    """Returns whether ``name`` is a sprite sheet manifest, or the sheet
+    its manifest currently points to.
+
+    ``manifests``, a dict, caches the manifests read between calls.
+    """
+
+    if manifests is None:
+        manifests = {}
+
+    def get_manifest(manifest_name):
+        if manifest_name not in manifests:
+            manifests[manifest_name] = read_manifest(storage, manifest_name)
+        return manifests[manifest_name]
+
+    if name.endswith('.json'):
+        return 'image' in get_manifest(name)
+
+    match = SHEET_NAME_RE.match(name)
+    return bool(match and
+                get_manifest(match.group(1) + '.json').get('image') == name)
+
+
+class SpriteSheet(object):
+    """Packs one fixed-size thumbnail of many instances into a single
+    image, with a map of where each instance's tile is.
+
+    Sheets are stored under ``upload_to``, on the field's storage, with
+    a JSON manifest named after the sheet. Rebuilding a sheet reads
+    only the thumbnails which changed, by name or by focal point;
+    unchanged tiles are copied from the previous sheet.
+
+    Example: ::
+
+        sheet = SpriteSheet('archive', BlogPost, 'artwork',
+                            'pagination_image').build(posts)
+    """
+
+    def __init__(self, name, model, field_name, thumbnail, columns=10,
+                 upload_to='sprites/', format='jpg', quality=90,
+                 bg_color='#FFFFFF'):
+        self.name = name
+        self.field = model._meta.get_field(field_name)
+        self.columns = columns
+        self.upload_to = upload_to
+        self.format = format
+        self.quality = quality
+        self.bg_color = bg_color
+
+        specs = dict((spec.attname, spec)
+                     for spec in self.field.thumbnail_specs)
+        try:
+            self.spec = specs[thumbnail]
+        except KeyError:
+            raise ImproperlyConfigured('%s has no thumbnail %r' %
+                                       (field_name, thumbnail))
+
+        # tiles take the thumbnail's own size, as the renderer cuts it
+        self.tile_size = self.spec.renderer.get_output_size()
+        if self.tile_size is None:
+            raise ImproperlyConfigured(
+                'Sprites need a fixed-size thumbnail, such as a '
+                'CropRenderer, not %r' % thumbnail)
+
+        self._manifest = None
+
+    @property
+    def storage(self):
+        return self.field.storage
+
+    @property
+    def manifest_name(self):
+        return posixpath.join(self.upload_to, '%s.json' % self.name)
+
+    @property
+    def manifest(self):
+        if self._manifest is None:
+            self._manifest = read_manifest(self.storage, self.manifest_name)
+        return self._manifest
+
+    @property
+    def url(self):
+        image_name = self.manifest.get('image')
+        return image_name and self.storage.url(image_name)
+
+    def get_position(self, instance):
+        """Returns the ``(x, y)`` offset of ``instance``'s tile, or
+        ``None`` if it is not on the sheet.
+        """
+
+        position = self.manifest.get('positions', {}).get(
+            unicode(instance.pk))
+        return position and tuple(position)
+
+    def get_members(self, instances):
+        """Returns the ``(pk, thumbnail name, version)`` of each member.
+
+        Thumbnails are re-rendered under the same name when the focal
+        point moves, so it versions their content.
+        """
+
+        members = []
+        for instance in instances:
+            field_file = getattr(instance, self.field.name)
+            if field_file.name:
+                thumbnail = getattr(field_file.thumbnails, self.spec.attname)
+                version = None
+                if self.spec.renderer.uses_focal_point:
+                    focal_point = field_file.focal_point
+                    version = focal_point and list(focal_point)
+                members.append((unicode(instance.pk), thumbnail.name,
+                                version))
+        return members
+
+    def build(self, instances):
+        """Packs the thumbnails of ``instances``, in order, and stores
+        the sheet and its manifest, unless nothing changed.
+
+        Returns the sheet.
+        """
+
+        from PIL import Image, ImageOps
+
+        members = self.get_members(instances)
+        digest = sha1(json.dumps([self.spec.version, self.columns,
+                                  members])).hexdigest()[:8]
+
+        previous = self.manifest
+        if previous.get('digest') == digest:
+            return self
+
+        width, height = self.tile_size
+        rows = max((len(members) + self.columns - 1) // self.columns, 1)
+        sheet = Image.new('RGB', (width * min(len(members) or 1,
+                                              self.columns), height * rows),
+                          self.bg_color)
+
+        previous_tiles = previous.get('tiles', {})
+        previous_sheet = None
+        if previous.get('image') and previous.get('tile') == [width, height]:
+            previous_sheet = self.open_image(previous['image'])
+
+        positions = {}
+        tiles = {}
+        for index, (pk, thumbnail_name, version) in enumerate(members):
+            position = ((index % self.columns) * width,
+                        (index // self.columns) * height)
+
+            previous_tile = previous_tiles.get(thumbnail_name)
+            if (previous_sheet is not None and previous_tile and
+                    previous_tile[2:] == [version]):
+                x, y = previous_tile[:2]
+                tile = previous_sheet.crop((x, y, x + width, y + height))
+            else:
+                tile = self.open_image(thumbnail_name)
+                if tile is not None and tile.size != self.tile_size:
+                    tile = ImageOps.fit(tile, self.tile_size, Image.ANTIALIAS)
+
+            if tile is not None:
+                sheet.paste(tile, position)
+            positions[pk] = position
+            tiles[thumbnail_name] = list(position) + [version]
+
+        image_name = posixpath.join(self.upload_to, '%s.%s.%s' % (
+            self.name, digest, self.format))
+        io = StringIO()
+        sheet.save(io, 'JPEG' if self.format.upper() == 'JPG' else
+                   self.format.upper(), quality=self.quality)
+        publish(self.storage, image_name, ContentFile(io.getvalue()))
+
+        self._manifest = {
+            'digest': digest,
+            'image': image_name,
+            'tile': [width, height],
+            'positions': positions,
+            'tiles': tiles,
+        }
+        publish(self.storage, self.manifest_name,
+                ContentFile(json.dumps(self._manifest)))
+
+        if previous.get('image') and previous['image'] != image_name:
+            self.storage.delete(previous['image'])
+
+        return self
+
+    def open_image(self, name):
+        """Returns the stored image ``name`` as RGB, or ``None`` if it
+        can't be read.
+        """
+
+        from PIL import Image
+
+        try:
+            image_file = self.storage.open(name)
+            try:
+                image = Image.open(StringIO(image_file.read()))
+                return image.convert('RGB')
+            finally:
+                image_file.close()
+        except (IOError, OSError):
+            return None
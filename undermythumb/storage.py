@@ -0,0 +1,513 @@
+from collections import OrderedDict
+from datetime import datetime
+import os
+import posixpath
+import threading
+import time
+import uuid
+
+from django.conf import settings
+from django.core.files.base import ContentFile, File
+from django.core.files.storage import (FileSystemStorage, Storage,
+                                       get_storage_class)
+from django.utils.deconstruct import deconstructible
+from django.utils.encoding import filepath_to_uri
+from django.utils.six.moves.urllib.parse import urljoin
+
+
+__all__ = ('AtomicFileSystemStorage', 'CachedStorage', 'InMemoryStorage',
+           'publish')
+
+
+class AtomicFileSystemStorage(FileSystemStorage):
+    """A ``FileSystemStorage`` which writes files atomically.
+
+    Files are written under a temporary name beside their destination,
+    then renamed into place, so readers never see a partial file.
+    ``save`` picks an available name, as usual, while ``replace``, used
+    by ``publish``, overwrites a file under its exact name: readers see
+    either the old file or the new one, never a missing file, and
+    concurrent writers of the same name simply race to the last rename,
+    without locks.
+    """
+
+    def replace(self, name, content):
+        """Saves ``content`` under exactly ``name``, atomically replacing
+        any existing file.
+        """
+
+        if not hasattr(content, 'chunks'):
+            content = File(content)
+        return self._save(name, content).replace('\\', '/')
+
+    def _save(self, name, content):
+        directory, basename = os.path.split(name)
+        tmp_name = os.path.join(directory, '.%s.%s.tmp' % (
+            basename, uuid.uuid4().hex))
+
+        tmp_name = super(AtomicFileSystemStorage, self)._save(tmp_name,
+                                                              content)
+        try:
+            os.rename(self.path(tmp_name), self.path(name))
+        except OSError:
+            self.delete(tmp_name)
+            raise
+
+        return name
+
+
+@deconstructible
+class InMemoryStorage(Storage):
+    """A storage holding files in memory, for test suites.
+
+    Every instance shares the same files, as a filesystem would, until
+    ``clear`` is called. Like ``AtomicFileSystemStorage.replace``, names are
+    never changed, and saving over a file replaces it.
+    """
+
+    _files = {}
+    _lock = threading.Lock()
+
+    def __init__(self, base_url=None):
+        if base_url is None:
+            base_url = settings.MEDIA_URL
+        self.base_url = base_url
+
+    def clear(self):
+        with self._lock:
+            self._files.clear()
+
+    def get_available_name(self, name, max_length=None):
+        return name
+
+    def _name(self, name):
+        return posixpath.normpath(name.replace('\\', '/')).lstrip('/')
+
+    def _open(self, name, mode='rb'):
+        try:
+            data, modified = self._files[self._name(name)]
+        except KeyError:
+            raise IOError('No such file: %r' % name)
+        content = ContentFile(data)
+        content.name = name
+        return content
+
+    def _save(self, name, content):
+        if hasattr(content, 'seek'):
+            content.seek(0)
+        data = ''.join(content.chunks())
+
+        with self._lock:
+            self._files[self._name(name)] = (data, datetime.now())
+        return name
+
+    def delete(self, name):
+        with self._lock:
+            self._files.pop(self._name(name), None)
+
+    def exists(self, name):
+        return self._name(name) in self._files
+
+    def listdir(self, path):
+        prefix = self._name(path)
+        prefix = prefix + '/' if prefix not in ('', '.') else ''
+
+        directories, files = set(), []
+        for name in list(self._files):
+            if not name.startswith(prefix):
+                continue
+            bits = name[len(prefix):].split('/', 1)
+            if len(bits) == 2:
+                directories.add(bits[0])
+            else:
+                files.append(bits[0])
+
+        return sorted(directories), sorted(files)
+
+    def size(self, name):
+        return len(self._open(name).read())
+
+    def url(self, name):
+        return urljoin(self.base_url, filepath_to_uri(name))
+
+    def modified_time(self, name):
+        try:
+            return self._files[self._name(name)][1]
+        except KeyError:
+            raise IOError('No such file: %r' % name)
+
+    accessed_time = created_time = modified_time
+
+
+@deconstructible
+class CachedStorage(Storage):
+    """A local disk cache in front of a remote storage.
+
+    Files written or read through this storage are kept on local disk,
+    up to ``max_size`` bytes, evicting the least recently used. Writes
+    land locally at once, and reach the remote storage in the
+    background, on ``writers`` threads; call ``flush`` to wait for
+    them. Files still being written are never evicted.
+
+    The cache belongs to the node, not the process: it is scanned on
+    startup, and again in the background every ``rescan_interval``
+    seconds, to count files written by other processes sharing
+    ``location``. Recency is kept in each file's access time, and the
+    remote modified time of the copy in its modification time.
+
+    Cached copies are read without asking the remote storage, as
+    thumbnail names change with their source. For files overwritten in
+    place by other nodes, set ``validate_interval``: a cached copy is
+    then checked against the remote modified time at most once every
+    ``validate_interval`` seconds, and fetched again if it changed.
+
+    By default, the remote storage is ``UNDERMYTHUMB_CACHE_REMOTE_STORAGE``,
+    the cache directory ``UNDERMYTHUMB_CACHE_LOCATION``, and its size
+    ``UNDERMYTHUMB_CACHE_SIZE``, in bytes.
+    """
+
+    def __init__(self, remote=None, location=None, max_size=None,
+                 writers=4, validate_interval=None, rescan_interval=60):
+        if remote is None:
+            remote = settings.UNDERMYTHUMB_CACHE_REMOTE_STORAGE
+        if isinstance(remote, basestring):
+            remote = get_storage_class(remote)()
+        if location is None:
+            location = settings.UNDERMYTHUMB_CACHE_LOCATION
+        if max_size is None:
+            max_size = getattr(settings, 'UNDERMYTHUMB_CACHE_SIZE',
+                               1024 * 1024 * 1024)
+
+        self.remote = remote
+        self.local = AtomicFileSystemStorage(location=location)
+        self.max_size = max_size
+        self.writers = writers
+        self.validate_interval = validate_interval
+        self.rescan_interval = rescan_interval
+
+        self._lock = threading.Lock()
+        self._index = OrderedDict()
+        self._pending = {}
+        self._writes = []
+        self._writer = None
+        self._size = 0
+        self._scanned = None
+        self._scanning = False
+        self._checked = {}
+        self._stats = {'hits': 0, 'misses': 0, 'revalidations': 0,
+                       'evictions': 0}
+
+        self._scan()
+
+    def _scan(self):
+        """Rebuilds the index from the files in the local tier, least
+        recently used first.
+        """
+
+        root = self.local.location
+        entries = []
+        for directory, _, filenames in os.walk(root):
+            for filename in filenames:
+                # files still being written by AtomicFileSystemStorage
+                if filename.startswith('.') and filename.endswith('.tmp'):
+                    continue
+                full_path = os.path.join(directory, filename)
+                try:
+                    stat = os.stat(full_path)
+                except OSError:
+                    continue
+                name = os.path.relpath(full_path, root).replace(os.sep, '/')
+                entries.append((stat.st_atime, name, stat.st_size))
+        entries.sort()
+        index = OrderedDict((name, size) for _, name, size in entries)
+
+        with self._lock:
+            # files cached while walking are kept, as most recently used
+            for name, size in self._index.items():
+                if name not in index and os.path.exists(self.local.path(name)):
+                    index[name] = size
+            self._index = index
+            self._size = sum(index.values())
+            self._checked = dict((name, checked) for name, checked
+                                 in self._checked.items() if name in index)
+            self._scanned = time.time()
+
+    def _rescan(self):
+        try:
+            self._scan()
+        finally:
+            with self._lock:
+                self._scanning = False
+        self._evict()
+
+    def _stamp(self, name, version=None):
+        """Marks the local copy of ``name`` as just used, and records
+        the remote ``version`` it holds, when given.
+        """
+
+        path = self.local.path(name)
+        try:
+            if version is None:
+                version = os.stat(path).st_mtime
+            os.utime(path, (time.time(), version))
+        except OSError:
+            pass
+
+    def _get_version(self, name):
+        """Returns the remote modified time of ``name``, as a timestamp,
+        or ``None`` if the remote storage can't tell.
+        """
+
+        try:
+            modified = self.remote.modified_time(name)
+        except NotImplementedError:
+            return None
+        return time.mktime(modified.timetuple()) + modified.microsecond / 1e6
+
+    def _needs_check(self, name):
+        """Returns whether the local copy of ``name`` is due to be
+        checked against the remote file.
+        """
+
+        if self.validate_interval is None:
+            return False
+
+        with self._lock:
+            if name in self._pending:
+                return False
+            checked = self._checked.get(name)
+        return (checked is None or
+                time.time() - checked >= self.validate_interval)
+
+    def _is_current(self, name):
+        """Returns whether the local copy of ``name`` matches the remote
+        file.
+        """
+
+        try:
+            version = self._get_version(name)
+        except (IOError, OSError):
+            return False
+        with self._lock:
+            self._checked[name] = time.time()
+        if version is None:
+            return True
+
+        try:
+            return abs(os.stat(self.local.path(name)).st_mtime -
+                       version) < 0.001
+        except OSError:
+            return False
+
+    def _cache(self, name, data, version=None):
+        """Stores ``data`` in the local tier, then evicts the least
+        recently used files over ``max_size``.
+        """
+
+        self.local.replace(name, ContentFile(data))
+        if version is not None:
+            self._stamp(name, version)
+            with self._lock:
+                self._checked[name] = time.time()
+
+        with self._lock:
+            self._size += len(data) - self._index.pop(name, 0)
+            self._index[name] = len(data)
+
+        self._evict(keep=name)
+
+    def _evict(self, keep=None):
+        with self._lock:
+            rescan = (not self._scanning and
+                      time.time() - self._scanned > self.rescan_interval)
+            if rescan:
+                self._scanning = True
+        if rescan:
+            # walking the cache is slow, so keep it off the request path
+            self._get_writer().apply_async(self._rescan)
+
+        evicted = []
+        with self._lock:
+            for cached_name in list(self._index):
+                if self._size <= self.max_size:
+                    break
+                if cached_name == keep or cached_name in self._pending:
+                    continue
+                self._size -= self._index.pop(cached_name)
+                self._checked.pop(cached_name, None)
+                self._stats['evictions'] += 1
+                evicted.append(cached_name)
+
+        for cached_name in evicted:
+            self.local.delete(cached_name)
+
+    def _touch(self, name):
+        """Marks ``name`` as recently used, returning whether it is
+        cached locally.
+        """
+
+        with self._lock:
+            if name not in self._index:
+                return False
+            self._index[name] = self._index.pop(name)
+            return True
+
+    def _open(self, name, mode='rb'):
+        if self._touch(name):
+            # hits never leave the node; checked copies are counted apart
+            if not self._needs_check(name):
+                stat = 'hits'
+            elif self._is_current(name):
+                stat = 'revalidations'
+            else:
+                stat = None
+
+            if stat is not None:
+                try:
+                    local_file = self.local.open(name, mode)
+                    self._stamp(name)
+                    with self._lock:
+                        self._stats[stat] += 1
+                    return local_file
+                except (IOError, OSError):
+                    pass
+
+        with self._lock:
+            self._stats['misses'] += 1
+        version = self._get_version(name)
+        remote_file = self.remote.open(name, mode)
+        try:
+            data = remote_file.read()
+        finally:
+            remote_file.close()
+
+        self._cache(name, data, version)
+        content = ContentFile(data)
+        content.name = name
+        return content
+
+    def _save(self, name, content):
+        if hasattr(content, 'seek'):
+            content.seek(0)
+        data = ''.join(content.chunks())
+
+        with self._lock:
+            self._pending[name] = self._pending.get(name, 0) + 1
+            self._writes = [result for result in self._writes
+                            if not (result.ready() and result.successful())]
+        self._cache(name, data)
+
+        result = self._get_writer().apply_async(self._save_remote,
+                                                (name, data))
+        with self._lock:
+            self._writes.append(result)
+        return name
+
+    def _get_writer(self):
+        from multiprocessing.pool import ThreadPool
+
+        with self._lock:
+            if self._writer is None:
+                self._writer = ThreadPool(self.writers)
+            return self._writer
+
+    def _save_remote(self, name, data):
+        try:
+            publish(self.remote, name, ContentFile(data))
+            self._stamp(name, self._get_version(name))
+            with self._lock:
+                self._checked[name] = time.time()
+        finally:
+            with self._lock:
+                self._pending[name] -= 1
+                if not self._pending[name]:
+                    del self._pending[name]
+
+            # files over the limit may have been waiting on this write
+            self._evict()
+
+    def flush(self):
+        """Waits for every background write to reach the remote
+        storage, raising the first error.
+        """
+
+        with self._lock:
+            results, self._writes = self._writes, []
+        for result in results:
+            result.wait()
+        for result in results:
+            result.get()
+
+    def get_available_name(self, name, max_length=None):
+        return self.remote.get_available_name(name)
+
+    def delete(self, name):
+        self.flush()
+        with self._lock:
+            self._size -= self._index.pop(name, 0)
+            self._checked.pop(name, None)
+        self.local.delete(name)
+        self.remote.delete(name)
+
+    def exists(self, name):
+        return name in self._index or self.remote.exists(name)
+
+    def listdir(self, path):
+        self.flush()
+        return self.remote.listdir(path)
+
+    def size(self, name):
+        size = self._index.get(name)
+        if size is None:
+            return self.remote.size(name)
+        return size
+
+    def url(self, name):
+        return self.remote.url(name)
+
+    def modified_time(self, name):
+        self.flush()
+        return self.remote.modified_time(name)
+
+    def accessed_time(self, name):
+        self.flush()
+        return self.remote.accessed_time(name)
+
+    def created_time(self, name):
+        self.flush()
+        return self.remote.created_time(name)
+
+    def get_stats(self):
+        """Returns hit, miss, revalidation and eviction counts, with the
+        local tier's size and pending remote writes. Hits are reads
+        served locally without asking the remote storage.
+        """
+
+        with self._lock:
+            stats = dict(self._stats)
+            stats.update({
+                'size': self._size,
+                'max_size': self.max_size,
+                'files': len(self._index),
+                'pending': len(self._pending),
+            })
+        return stats
+
+
+def publish(storage, name, content):
+    """Saves ``content`` to ``storage`` under exactly ``name``, replacing
+    any existing file.
+
+    Storages with a ``replace`` method, like ``AtomicFileSystemStorage``,
+    overwrite through it, and those which overwrite in place, like most
+    object stores, are written directly. Others have the existing file
+    deleted first, so the name stays predictable.
+    """
+
+    if hasattr(storage, 'replace'):
+        return storage.replace(name, content)
+
+    if storage.get_available_name(name) != name:
+        storage.delete(name)
+
+    return storage.save(name, content)
@@ -0,0 +1,157 @@
+from hashlib import sha1
+
+from django import template
+from django.conf import settings
+from django.core.cache import DEFAULT_CACHE_ALIAS, caches
+from django.core.cache.backends.base import DEFAULT_TIMEOUT
+from django.utils.encoding import force_bytes
+from django.utils.html import format_html, format_html_join
+from django.utils.safestring import mark_safe
+
+
+register = template.Library()
+
+
+def get_markup_cache():
+    return caches[getattr(settings, 'UNDERMYTHUMB_MARKUP_CACHE',
+                          DEFAULT_CACHE_ALIAS)]
+
+
+def get_thumbnail_size(field_file, spec):
+    """Returns a thumbnail's ``(width, height)``, without reading any
+    image, or ``None`` when it can't be known.
+    """
+
+    field = field_file.field
+    source_size = None
+
+    if field.width_field and field.height_field:
+        source_size = (getattr(field_file.instance, field.width_field),
+                       getattr(field_file.instance, field.height_field))
+        if not all(source_size):
+            source_size = None
+
+    return spec.renderer.get_output_size(source_size)
+
+
+def get_attributes(attrs):
+    return format_html_join('', ' {0}="{1}"', sorted(attrs.items()))
+
+
+def render_img(field_file, specs, attrs):
+    thumbnails = field_file.thumbnails
+    spec = specs[0]
+
+    attributes = {'src': getattr(thumbnails, spec.attname).url}
+
+    size = get_thumbnail_size(field_file, spec)
+    if size is not None:
+        attributes['width'], attributes['height'] = size
+
+    if len(specs) > 1:
+        srcset = []
+        for srcset_spec in specs:
+            size = get_thumbnail_size(field_file, srcset_spec)
+            if size is not None:
+                srcset.append('%s %dw' % (
+                    getattr(thumbnails, srcset_spec.attname).url, size[0]))
+        if srcset:
+            attributes['srcset'] = ', '.join(srcset)
+
+    attributes.update(attrs)
+    return format_html('<img{0} />', get_attributes(attributes))
+
+
+def render_picture(field_file, specs, attrs, media):
+    thumbnails = field_file.thumbnails
+
+    sources = format_html_join('', '<source media="{0}" srcset="{1}" />', (
+        (query, getattr(thumbnails, spec.attname).url)
+        for query, spec in zip(media, specs)))
+
+    return format_html('<picture>{0}{1}</picture>', sources,
+                       render_img(field_file, specs[-1:], attrs))
+
+
+def render_markup(field_file, sizes, attrs, render, *args):
+    """Renders markup for the thumbnails ``sizes`` of ``field_file``,
+    through the markup cache.
+
+    Cache keys include the source's name, and each thumbnail's spec
+    version, so markup is never stale; nothing needs invalidating.
+    """
+
+    if not getattr(field_file, 'name', None):
+        return ''
+
+    specs = dict((spec.attname, spec)
+                 for spec in field_file.field.thumbnail_specs)
+    try:
+        specs = [specs[size] for size in sizes]
+    except KeyError:
+        return ''
+
+    key = 'undermythumb.markup.%s' % sha1(force_bytes(repr((
+        render.__name__, field_file.name,
+        [(spec.attname, spec.version) for spec in specs],
+        sorted(attrs.items()), args)))).hexdigest()
+
+    cache = get_markup_cache()
+    markup = cache.get(key)
+    if markup is None:
+        markup = unicode(render(field_file, specs, attrs, *args))
+        cache.set(key, markup, getattr(settings, 'UNDERMYTHUMB_MARKUP_TIMEOUT',
+                                       DEFAULT_TIMEOUT))
+
+    return mark_safe(markup)
+
+
+@register.simple_tag
+def thumbnail_img(field_file, size, *srcset, **attrs):
+    """Renders an ``<img>`` tag for the thumbnail ``size``.
+
+    Extra sizes are listed, with ``size``, in a ``srcset``. Keyword
+    arguments become attributes. Usage: ::
+
+        {% load undermythumb_tags %}
+        {% thumbnail_img post.artwork 'small' 'large' alt=post.title %}
+    """
+
+    return render_markup(field_file, (size, ) + srcset, attrs, render_img)
+
+
+@register.simple_tag
+def thumbnail_picture(field_file, *sources, **attrs):
+    """Renders a ``<picture>`` tag, from pairs of media queries and
+    thumbnail sizes, followed by a fallback size. Usage: ::
+
+        {% thumbnail_picture post.artwork '(max-width: 600px)' 'small' 'large' %}
+    """
+
+    if not len(sources) % 2:
+        raise template.TemplateSyntaxError(
+            'thumbnail_picture takes media and size pairs, followed by '
+            'a fallback size')
+
+    media, sizes = sources[:-1:2], sources[1::2] + sources[-1:]
+    return render_markup(field_file, sizes, attrs, render_picture, media)
+
+
+@register.simple_tag
+def sprite_style(sheet, instance):
+    """Renders inline CSS showing ``instance``'s tile of a
+    ``SpriteSheet``. Usage: ::
+
+        <span style="{% sprite_style sheet post %}"></span>
+    """
+
+    position = sheet.get_position(instance)
+    url = sheet.url
+    if position is None or not url:
+        return ''
+
+    offsets = ['-%dpx' % offset if offset else '0' for offset in position]
+    return format_html(
+        'background: url({0}) {1} {2} no-repeat; '
+        'width: {3}px; height: {4}px;',
+        url, offsets[0], offsets[1], *sheet.tile_size)
@@ -0,0 +1,59 @@
+import base64
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.core.files.base import ContentFile
+
+
+__all__ = ('stub_renders_enabled', 'stub_render', 'record_renders')
+
+
+# a 1x1 transparent GIF, returned for every stubbed render
+STUB_IMAGE = base64.b64decode(
+    'R0lGODlhAQABAIAAAAAAAP///yH5BAEAAAAALAAAAAABAAEAAAIBRAA7')
+
+STUB_METADATA = {
+    'color': '#000000',
+    'placeholder': 'data:image/gif;base64,%s' % base64.b64encode(STUB_IMAGE),
+}
+
+_recorders = []
+
+
+def stub_renders_enabled():
+    """Returns whether ``UNDERMYTHUMB_STUB_RENDERS`` is set, in which
+    case renderers skip decoding and encoding entirely.
+    """
+
+    return getattr(settings, 'UNDERMYTHUMB_STUB_RENDERS', False)
+
+
+def stub_render(renderer, metadata=None, describe=True, **options):
+    """Records a render, and returns a tiny placeholder image in its
+    place.
+    """
+
+    for renders in _recorders:
+        renders.append((renderer, options))
+
+    if metadata is not None and describe:
+        metadata.update(STUB_METADATA)
+    return ContentFile(STUB_IMAGE)
+
+
+@contextmanager
+def record_renders():
+    """Collects the ``(renderer, options)`` of every stubbed render
+    made inside the block. Usage: ::
+
+        with record_renders() as renders:
+            post = Post.objects.create(artwork=upload)
+        self.assertEqual(len(renders), 2)
+    """
+
+    renders = []
+    _recorders.append(renders)
+    try:
+        yield renders
+    finally:
+        _recorders.remove(renders)
@@ -1,7 +1,11 @@
 from django.db import models
 
+from undermythumb.contrib.fields import (PostSaveImageField,
+                                         PostSaveImageFallbackField)
 from undermythumb.fields import ImageWithThumbnailsField, ImageFallbackField
-from undermythumb.renderers import CropRenderer
+from undermythumb.managers import FallbackManager
+from undermythumb.renderers import CropRenderer, ResizeRenderer
+from undermythumb.storage import InMemoryStorage
 
 
 class BlogPost(models.Model):
@@ -26,3 +30,112 @@ class BlogPost(models.Model):
 
     def __unicode__(self):
         return self.title
+
+
+class FocalPointPost(models.Model):
+    # crops anchor on the focal point, guessed on upload
+    artwork = ImageWithThumbnailsField(
+        upload_to='artwork/',
+        focus_x_field='artwork_focus_x',
+        focus_y_field='artwork_focus_y',
+        auto_focus=True,
+        metadata_field='artwork_metadata',
+        thumbnails=(('banner', CropRenderer(300, 150)),
+                    ('landscape', CropRenderer(400, 300)),
+                    ('resized', ResizeRenderer(100, 100))))
+    artwork_focus_x = models.FloatField(blank=True, null=True)
+    artwork_focus_y = models.FloatField(blank=True, null=True)
+    artwork_metadata = models.TextField(blank=True)
+
+
+class PostSaveBlogPost(models.Model):
+    title = models.CharField(max_length=100)
+
+    # files are saved once the post has a primary key
+    artwork = PostSaveImageField(
+        max_length=255,
+        upload_to='artwork/',
+        thumbnails=(('homepage_image', CropRenderer(300, 150)), ))
+    homepage_image = PostSaveImageFallbackField(
+        fallback_path='artwork.thumbnails.homepage_image',
+        upload_to='artwork/')
+
+
+class Author(models.Model):
+    name = models.CharField(max_length=100)
+    avatar = ImageWithThumbnailsField(
+        upload_to='artwork/',
+        thumbnails=(('small', CropRenderer(50, 50)), ))
+
+
+class Article(models.Model):
+    title = models.CharField(max_length=100)
+    author = models.ForeignKey(Author)
+
+    # falls back across the author relation
+    header = ImageFallbackField(
+        fallback_path='author.avatar.thumbnails.small',
+        upload_to='artwork/')
+
+    objects = FallbackManager()
+
+
+class ChainedPost(models.Model):
+    artwork = ImageWithThumbnailsField(
+        upload_to='artwork/',
+        blank=True,
+        thumbnails=(('list', CropRenderer(100, 100)), ))
+    editorial_image = models.ImageField(upload_to='artwork/', blank=True)
+    default_image = models.ImageField(upload_to='artwork/', blank=True)
+
+    # editorial override, then auto-crop, then default artwork
+    list_image = ImageFallbackField(
+        fallback_path=['editorial_image',
+                       'artwork.thumbnails.list',
+                       'default_image'],
+        upload_to='artwork/')
+
+
+class PublishedManager(models.Manager):
+
+    def get_queryset(self):
+        return super(PublishedManager, self).get_queryset().filter(
+            published=True)
+
+
+class DraftPost(models.Model):
+    published = models.BooleanField(default=False)
+    artwork = ImageWithThumbnailsField(
+        upload_to='artwork/',
+        thumbnails=(('draft_image', CropRenderer(100, 100)), ))
+
+    # hides unpublished posts, which still reference their files
+    objects = PublishedManager()
+
+
+class ShardedPost(models.Model):
+    artwork = ImageWithThumbnailsField(
+        upload_to='artwork/',
+        shard_depth=2,
+        thumbnails=(('homepage_image', CropRenderer(300, 150)), ))
+
+
+class BudgetPost(models.Model):
+    # byte budgets, with no metadata field to keep their qualities in
+    artwork = ImageWithThumbnailsField(
+        upload_to='artwork/',
+        thumbnails=(('small', CropRenderer(100, 100, max_bytes=3000)), ))
+
+
+class InMemoryPost(models.Model):
+    # files never touch disk
+    artwork = ImageWithThumbnailsField(
+        upload_to='artwork/',
+        storage=InMemoryStorage(),
+        auto_focus=True,
+        thumbnails=(('banner', CropRenderer(300, 150)),
+                    ('resized', ResizeRenderer(100, 100))))
+    banner = ImageFallbackField(
+        fallback_path='artwork.thumbnails.banner',
+        upload_to='artwork/',
+        storage=InMemoryStorage())
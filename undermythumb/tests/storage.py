@@ -1,12 +1,7 @@
-import os
+from undermythumb.storage import AtomicFileSystemStorage
 
-from django.conf import settings
-from django.core.files.storage import FileSystemStorage
 
+class FileSystemOverwriteStorage(AtomicFileSystemStorage):
 
-class FileSystemOverwriteStorage(FileSystemStorage):
-
-    def get_available_name(self, name):
-        if self.exists(name):
-            os.remove(os.path.join(settings.MEDIA_ROOT, name))
+    def get_available_name(self, name, max_length=None):
         return name
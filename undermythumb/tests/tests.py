@@ -1,18 +1,67 @@
+from cStringIO import StringIO
 import os
 import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
 
+from django.core.exceptions import ImproperlyConfigured
+from django.core.files.base import ContentFile
 from django.core.files.images import ImageFile
+from django.core.files.storage import FileSystemStorage
+from django.core.management import call_command
 from django.db import connection
+from django.template import Context, Template
 from django.test import TestCase
+from django.test.utils import override_settings
 
-from undermythumb.tests.models import BlogPost
+from PIL import Image, ImageCms, ImageSequence, ImageStat
+
+from undermythumb import backends, renderers
+from undermythumb.backends import (get_backend, get_backends,
+                                   get_color_transform)
+from undermythumb.fields import (ImageWithThumbnailsField,
+                                 get_fallback_relations)
+from undermythumb.files import get_recorded_quality
+from undermythumb.ingest import bulk_ingest
+from undermythumb.overlays import (OverlayRenderer, clear_overlays,
+                                   get_overlay)
+from undermythumb.pipeline import (Border, Crop, PipelineRenderer, Resize,
+                                   Sharpen, fuse_geometry)
+from undermythumb.renderers import (CropRenderer, LetterboxRenderer,
+                                    ResizeRenderer)
+from undermythumb.scheduler import RenderScheduler, RenderTimeout
+from undermythumb.specs import compile_thumbnail_specs
+from undermythumb.sprites import SpriteSheet
+from undermythumb.storage import (AtomicFileSystemStorage, CachedStorage,
+                                  InMemoryStorage, publish)
+from undermythumb.testing import record_renders
+from undermythumb.tests.models import (Article, Author, BlogPost,
+                                      BudgetPost, ChainedPost, DraftPost,
+                                      FocalPointPost, InMemoryPost,
+                                      PostSaveBlogPost, ShardedPost)
 
 
 root = os.path.dirname(__file__)
 path = lambda *p: os.path.join(root, *p)
 
 
-class UnderMyThumbTestSuite(TestCase):
+class ThumbnailTestCase(TestCase):
+
+    def tearDown(self):
+        if os.path.exists(os.path.realpath('./artwork')):
+            shutil.rmtree(os.path.realpath('./artwork'))
+
+    def get_test_image(self):
+        return ImageFile(open(path('statler_waldorf.jpg')))
+
+    def get_test_thumbnail(self):
+        return ImageFile(open(path('sweetums_lecture.jpg')))
+
+
+class UnderMyThumbTestSuite(ThumbnailTestCase):
     """Test the follow scenarios:
 
     1. Upload 'artwork' image, verify that ImageFallbackField fields are blank.
@@ -26,15 +75,6 @@ class UnderMyThumbTestSuite(TestCase):
     def setUp(self):
         self.cursor = connection.cursor()
 
-    def tearDown(self):
-        shutil.rmtree(os.path.realpath('./artwork'))
-
-    def get_test_image(self):
-        return ImageFile(open(path('statler_waldorf.jpg')))
-
-    def get_test_thumbnail(self):
-        return ImageFile(open(path('sweetums_lecture.jpg')))
-
     def get_db_thumbnails(self, db_table, instance_id, *thumbnail_names):
         self.cursor.execute('select homepage_image from %s where id=%s' %
                             (db_table, instance_id))
@@ -119,3 +159,985 @@ class UnderMyThumbTestSuite(TestCase):
         # assert that the correct thumbnail is generated
         self.assertEqual(post.homepage_image.url,
                          post.artwork.thumbnails.homepage_image.url)
+
+
+class FocalPointTestSuite(ThumbnailTestCase):
+    """Ensures crops follow the focal point, and that moving it only
+    re-renders the crops it changes.
+    """
+
+    def test_auto_focus(self):
+        post = FocalPointPost.objects.create(artwork=self.get_test_image())
+        post = FocalPointPost.objects.get(id=post.id)
+
+        self.assertTrue(0 <= post.artwork_focus_x <= 1)
+        self.assertTrue(0 <= post.artwork_focus_y <= 1)
+
+    def test_set_focal_point(self):
+        post = FocalPointPost.objects.create(artwork=self.get_test_image())
+        post.artwork.set_focal_point(0.5, 0.5)
+
+        # only the banner crop discards part of the 4:3 source
+        rerendered = post.artwork.set_focal_point(0.5, 0.)
+        self.assertEqual([t.attname for t in rerendered], ['banner'])
+        self.assertEqual(post.artwork.set_focal_point(0.5, 0.), [])
+
+        post = FocalPointPost.objects.get(id=post.id)
+        self.assertEqual(post.artwork.focal_point, (0.5, 0.))
+        self.assertEqual(post.artwork.url, 'artwork/b3d23ba4.jpg')
+
+    def test_replaced_source(self):
+        """Ensures replacing the source guesses its focal point again,
+        unless one was set for the new upload.
+        """
+
+        post = FocalPointPost.objects.create(artwork=self.get_test_image())
+        post.artwork.set_focal_point(0.05, 0.05)
+
+        post.artwork.save('new.jpg', self.get_test_thumbnail())
+        fresh = FocalPointPost.objects.create(
+            artwork=self.get_test_thumbnail())
+        self.assertEqual(post.artwork.focal_point, fresh.artwork.focal_point)
+
+        post.artwork.focal_point = (0.25, 0.75)
+        post.artwork.save('old.jpg', self.get_test_image())
+        post = FocalPointPost.objects.get(id=post.id)
+        self.assertEqual(post.artwork.focal_point, (0.25, 0.75))
+
+    def test_set_focal_point_atomic(self):
+        """Ensures a moved crop replaces the old thumbnail in place, so
+        it stays readable until the new one is published.
+        """
+
+        post = FocalPointPost.objects.create(artwork=self.get_test_image())
+        post.artwork.set_focal_point(0.5, 0.5)
+
+        storage = post.artwork.field.storage
+        name = post.artwork.thumbnails.banner.name
+        previous = storage.open(name).read()
+        readable = []
+
+        def save(name, content):
+            readable.append(storage.open(name).read() == previous)
+            return AtomicFileSystemStorage._save(storage, name, content)
+
+        storage._save = save
+        try:
+            post.artwork.set_focal_point(0.5, 0.)
+        finally:
+            del storage._save
+
+        self.assertEqual(readable, [True])
+        self.assertNotEqual(storage.open(name).read(), previous)
+
+
+class ThumbnailMetadataTestSuite(ThumbnailTestCase):
+
+    def test_metadata(self):
+        """Ensures colors and placeholders are stored at render time.
+        """
+
+        post = FocalPointPost.objects.create(artwork=self.get_test_image())
+        post = FocalPointPost.objects.get(id=post.id)
+
+        for thumbnail in post.artwork.thumbnails:
+            self.assertTrue(thumbnail.placeholder.startswith(
+                'data:image/jpeg;base64,'))
+            self.assertEqual(len(thumbnail.color), 7)
+
+
+class ByteBudgetTestSuite(TestCase):
+
+    def test_max_bytes(self):
+        """Ensures byte-budget encodes fit, and record their quality.
+        """
+
+        content = ContentFile(open(path('statler_waldorf.jpg')).read())
+        renderer = CropRenderer(300, 300, max_bytes=10000)
+
+        metadata = {}
+        rendered = renderer.generate(content, metadata)
+        self.assertTrue(rendered.size <= 10000)
+        self.assertTrue(1 < metadata['quality'] < 100)
+
+        # a recorded quality is the first guess, and is kept if it fits
+        renderer.max_attempts = 1
+        again = {'quality': metadata['quality']}
+        self.assertEqual(renderer.generate(content, again).size,
+                         rendered.size)
+        self.assertEqual(again['quality'], metadata['quality'])
+
+    def test_predicted_quality(self):
+        """Ensures the first encode tried is predicted from the source,
+        and usually fits.
+        """
+
+        content = ContentFile(open(path('statler_waldorf.jpg')).read())
+        renderer = CropRenderer(300, 300, max_bytes=10000, max_attempts=1)
+
+        metadata = {}
+        self.assertTrue(renderer.generate(content, metadata).size <= 10000)
+        self.assertEqual(metadata['quality'],
+                         renderer.predict_quality((115567 / 786432., 786432),
+                                                  (300, 300)))
+
+    def test_animated_exempt(self):
+        frames = [Image.new('RGB', (40, 20), (i * 40, 0, 0))
+                  for i in range(3)]
+        io = StringIO()
+        frames[0].save(io, 'GIF', save_all=True, append_images=frames[1:])
+
+        metadata = {}
+        renderer = CropRenderer(10, 10, format='webp', animated=True,
+                                max_bytes=1)
+        rendered = Image.open(renderer.generate(ContentFile(io.getvalue()),
+                                                metadata))
+        self.assertTrue(rendered.is_animated)
+        self.assertFalse('quality' in metadata)
+
+    def test_recorded_without_metadata_field(self):
+        self.addCleanup(shutil.rmtree, os.path.realpath('./artwork'))
+
+        # without a metadata field, only the quality is worked out
+        get_image_metadata = renderers.get_image_metadata
+        renderers.get_image_metadata = None
+        try:
+            post = BudgetPost.objects.create(
+                artwork=ImageFile(open(path('statler_waldorf.jpg'))))
+        finally:
+            renderers.get_image_metadata = get_image_metadata
+
+        self.assertTrue(get_recorded_quality(
+            post.artwork.thumbnails.small.name))
+
+
+class ThumbnailSpecTestSuite(TestCase):
+
+    def test_compile(self):
+        specs = compile_thumbnail_specs((
+            ('small', CropRenderer(10, 10, format='png')),
+            ('large', CropRenderer(20, 20), 'big')))
+
+        self.assertEqual([(s.attname, s.key, s.ext) for s in specs],
+                         [('small', 'small', '.png'),
+                          ('large', 'big', '.jpg')])
+        self.assertEqual(specs[1].get_filename('artwork/', 'b3d23ba4'),
+                         'artwork/big.b3d23ba4.jpg')
+
+    def test_stable_version(self):
+        """Ensures versions of nested renderers match across processes.
+        """
+
+        script = ('import sys, django; django.setup(); '
+                  'from undermythumb.pipeline import *; '
+                  'from undermythumb.specs import ThumbnailSpec; '
+                  'sys.stdout.write(ThumbnailSpec.compile(("list", '
+                  'PipelineRenderer([Crop(300, 300), Resize(150, 150), '
+                  'Sharpen(), Border(2)]))).version)')
+        env = dict(os.environ, PYTHONPATH=os.pathsep.join(sys.path))
+
+        versions = set(subprocess.check_output([sys.executable, '-c', script],
+                                               env=env)
+                       for i in range(2))
+        self.assertEqual(len(versions), 1)
+
+    def test_invalid_definitions(self):
+        for thumbnails in ((('small', ), ),
+                           (('small', None), ),
+                           (('small', CropRenderer(10, 10)),
+                            ('small', CropRenderer(20, 20)))):
+            self.assertRaises(ImproperlyConfigured,
+                              compile_thumbnail_specs, thumbnails)
+
+    def test_invalid_shard_depth(self):
+        for shard_depth in (-1, 5, 1.5):
+            self.assertRaises(ImproperlyConfigured, ImageWithThumbnailsField,
+                              upload_to='artwork/', shard_depth=shard_depth)
+
+    def test_thumbnail_names(self):
+        post = BlogPost(id=1, artwork='artwork/b3d23ba4.jpg')
+
+        self.assertEqual(sorted(t.name for t in post.artwork.thumbnails),
+                         ['artwork/homepage_image.b3d23ba4.jpg',
+                          'artwork/pagination_image.b3d23ba4.jpg'])
+
+
+class PostSaveFieldTestSuite(ThumbnailTestCase):
+
+    def test_single_update(self):
+        """Ensures all post-save files are persisted in one UPDATE,
+        or in the instance's own write once it has a primary key.
+        """
+
+        with self.assertNumQueries(2):
+            post = PostSaveBlogPost.objects.create(
+                title='Test Post',
+                artwork=self.get_test_image(),
+                homepage_image=self.get_test_thumbnail())
+
+        post = PostSaveBlogPost.objects.get(id=post.id)
+        self.assertEqual(post.artwork.name, 'artwork/b3d23ba4.jpg')
+        self.assertEqual(post.homepage_image.name,
+                         'artwork/sweetums_lecture.jpg')
+
+        post.homepage_image = self.get_test_image()
+        with self.assertNumQueries(1):
+            post.save()
+
+        post = PostSaveBlogPost.objects.get(id=post.id)
+        self.assertEqual(post.homepage_image.name,
+                         'artwork/statler_waldorf.jpg')
+
+
+class AnimatedRendererTestSuite(TestCase):
+
+    def get_animated_image(self, frame_count=6):
+        frames = [Image.new('RGB', (40, 20), (i * 40, 0, 0))
+                  for i in range(frame_count)]
+        io = StringIO()
+        frames[0].save(io, 'GIF', save_all=True, append_images=frames[1:],
+                       duration=50, loop=0)
+        return ContentFile(io.getvalue())
+
+    def test_first_frame(self):
+        renderer = CropRenderer(10, 10, format='gif')
+        rendered = Image.open(renderer.generate(self.get_animated_image()))
+
+        self.assertEqual(rendered.size, (10, 10))
+        self.assertFalse(getattr(rendered, 'is_animated', False))
+
+    def test_animated(self):
+        renderer = CropRenderer(10, 10, format='gif', animated=True,
+                                max_frames=2, frame_step=2)
+        rendered = Image.open(renderer.generate(self.get_animated_image()))
+        frames = list(ImageSequence.Iterator(rendered))
+
+        self.assertEqual(len(frames), 2)
+        self.assertEqual(frames[0].size, (10, 10))
+        self.assertEqual(frames[0].info['duration'], 100)
+
+    def test_max_frames_read(self):
+        """Ensures frames past ``max_frames`` are never read."""
+
+        read = []
+        iterator = ImageSequence.Iterator
+
+        class CountingIterator(iterator):
+            def next(self):
+                frame = iterator.next(self)
+                # saving the output iterates its frames too
+                if frame.format == 'GIF':
+                    read.append(frame.tell())
+                return frame
+
+        ImageSequence.Iterator = CountingIterator
+        try:
+            CropRenderer(10, 10, format='gif', animated=True,
+                         max_frames=2).generate(self.get_animated_image())
+        finally:
+            ImageSequence.Iterator = iterator
+
+        self.assertEqual(read, [0, 1])
+
+
+class ColorRendererTestSuite(TestCase):
+
+    def get_image(self, mode, color, **kwargs):
+        io = StringIO()
+        Image.new(mode, (80, 60), color).save(io, 'JPEG', **kwargs)
+        return ContentFile(io.getvalue())
+
+    def test_cmyk(self):
+        content = self.get_image('CMYK', (0, 255, 255, 0))
+
+        for renderer in (CropRenderer(20, 20),
+                         LetterboxRenderer(20, 20, format='png')):
+            rendered = Image.open(renderer.generate(content))
+            self.assertEqual(rendered.size, (20, 20))
+            self.assertTrue(rendered.mode in ('RGB', 'RGBA'))
+
+    def test_icc_profile(self):
+        icc_profile = ImageCms.ImageCmsProfile(
+            ImageCms.createProfile('sRGB')).tobytes()
+        content = self.get_image('RGB', (200, 10, 10),
+                                 icc_profile=icc_profile)
+
+        rendered = Image.open(CropRenderer(20, 20).generate(content))
+        red, green, blue = rendered.getpixel((10, 10))
+        self.assertTrue(red > 150 and green < 50 and blue < 50)
+
+        # transforms are built once per profile
+        self.assertTrue(get_color_transform(icc_profile, 'RGB', 'RGB') is
+                        get_color_transform(icc_profile, 'RGB', 'RGB'))
+
+    def test_transform_cache(self):
+        """Ensures only the least recently used transform is evicted."""
+
+        icc_profile = ImageCms.ImageCmsProfile(
+            ImageCms.createProfile('sRGB')).tobytes()
+        modes = [('RGB', 'RGB'), ('RGBA', 'RGBA'), ('RGB', 'RGBA')]
+
+        cache_size = backends.TRANSFORM_CACHE_SIZE
+        backends.TRANSFORM_CACHE_SIZE = 2
+        try:
+            first, second = [get_color_transform(icc_profile, *pair)
+                             for pair in modes[:2]]
+            get_color_transform(icc_profile, *modes[0])
+            get_color_transform(icc_profile, *modes[2])
+
+            self.assertTrue(get_color_transform(icc_profile, *modes[0])
+                            is first)
+            self.assertFalse(get_color_transform(icc_profile, *modes[1])
+                             is second)
+        finally:
+            backends.TRANSFORM_CACHE_SIZE = cache_size
+
+
+class LazyImportTestSuite(TestCase):
+
+    def test_no_pil_on_import(self):
+        """Ensures models and thumbnail names never import PIL."""
+
+        script = ('import sys, django; django.setup(); '
+                  'from undermythumb.tests.models import FocalPointPost; '
+                  'post = FocalPointPost(artwork="artwork/b3d23ba4.jpg"); '
+                  'list(post.artwork.thumbnails); '
+                  'sys.stdout.write(str("PIL.Image" in sys.modules))')
+        env = dict(os.environ, PYTHONPATH=os.pathsep.join(sys.path))
+
+        output = subprocess.check_output([sys.executable, '-c', script],
+                                         env=env)
+        self.assertEqual(output, 'False')
+
+
+class ImageBackendTestSuite(TestCase):
+
+    def test_load_size(self):
+        # a 100x100 crop needs no more than a 134x100 source
+        self.assertEqual(CropRenderer(100, 100).get_load_size((1024, 768)),
+                         (134, 100))
+        self.assertEqual(ResizeRenderer(2048, 2048).get_load_size(
+            (1024, 768)), None)
+
+    def test_backend_parity(self):
+        """Ensures every registered backend renders the same sizes and
+        colors as PIL.
+        """
+
+        content = ContentFile(open(path('statler_waldorf.jpg')).read())
+        renderers = lambda backend: (
+            CropRenderer(120, 80, backend=backend),
+            ResizeRenderer(120, 120, backend=backend),
+            LetterboxRenderer(120, 120, format='png', backend=backend))
+
+        reference = [Image.open(renderer.generate(content))
+                     for renderer in renderers('pil')]
+
+        for name in get_backends():
+            self.assertTrue(get_backend(name) is not None)
+            for renderer, expected in zip(renderers(name), reference):
+                rendered = Image.open(renderer.generate(content))
+                self.assertEqual(rendered.size, expected.size)
+
+                for channel, mean in enumerate(ImageStat.Stat(
+                        rendered.convert('RGB')).mean):
+                    self.assertTrue(abs(mean - ImageStat.Stat(
+                        expected.convert('RGB')).mean[channel]) < 8)
+
+        self.assertRaises(ImproperlyConfigured, get_backend, 'missing')
+
+    def test_decode_region(self):
+        """Ensures crops of tall sources stop decoding below the crop.
+        """
+
+        source = Image.new('RGB', (60, 600))
+        source.putdata([(0, y % 256, 0) for y in range(600)
+                        for x in range(60)])
+        io = StringIO()
+        source.save(io, 'PNG')
+
+        backend = get_backend('pil')
+        image, box = backend.decode_region(backend.open(io),
+                                           (0, 270, 60, 330))
+        self.assertEqual((image.size, box), ((60, 330), (0, 270, 60, 330)))
+
+        rendered = Image.open(CropRenderer(60, 60, format='png').generate(
+            ContentFile(io.getvalue())))
+        self.assertEqual(list(rendered.getdata()),
+                         list(source.crop((0, 270, 60, 330)).getdata()))
+
+
+class PipelineRendererTestSuite(TestCase):
+
+    def test_fuse_geometry(self):
+        self.assertEqual(fuse_geometry([Crop(300, 300), Resize(150, 150)],
+                                       (1024, 768)),
+                         ((128., 0., 896., 768.), (150, 150)))
+
+    def test_pipeline(self):
+        """Ensures pipelines render in one resample, and rebuild from
+        their deconstruction.
+        """
+
+        renderer = PipelineRenderer([Crop(300, 300), Resize(150, 150),
+                                     Sharpen(), Border(2, '#FF0000')],
+                                    format='png')
+        args, kwargs = renderer.deconstruct()[1:]
+        self.assertEqual(PipelineRenderer(*args, **kwargs), renderer)
+        self.assertEqual(renderer.get_output_size(), (150, 150))
+
+        content = ContentFile(open(path('statler_waldorf.jpg')).read())
+        rendered = Image.open(renderer.generate(content))
+        self.assertEqual(rendered.size, (150, 150))
+        self.assertEqual(rendered.getpixel((1, 1)), (255, 0, 0))
+
+        expected = Image.open(CropRenderer(150, 150, format='png').generate(
+            content)).crop((10, 10, 140, 140))
+        for channel, mean in enumerate(ImageStat.Stat(
+                rendered.crop((10, 10, 140, 140))).mean):
+            self.assertTrue(abs(mean - ImageStat.Stat(expected).mean[channel])
+                            < 8)
+
+
+class OverlayRendererTestSuite(TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.asset = os.path.join(self.directory, 'overlay.png')
+        Image.new('RGBA', (40, 20), (0, 0, 0, 255)).save(self.asset)
+        clear_overlays()
+
+    def tearDown(self):
+        clear_overlays()
+        shutil.rmtree(self.directory)
+
+    def test_overlay(self):
+        """Ensures overlays are composited onto the thumbnail, and
+        scaled once per size.
+        """
+
+        renderer = OverlayRenderer(200, 100, self.asset, scale=0.5,
+                                   opacity=0.5, margin=0, format='png')
+        args, kwargs = renderer.deconstruct()[1:]
+        self.assertEqual(OverlayRenderer(*args, **kwargs), renderer)
+
+        io = StringIO()
+        Image.new('RGB', (800, 400), (255, 255, 255)).save(io, 'PNG')
+        content = ContentFile(io.getvalue())
+
+        rendered = Image.open(renderer.generate(content))
+        self.assertEqual(rendered.size, (200, 100))
+        self.assertEqual(rendered.getpixel((0, 0)), (255, 255, 255))
+        # a 100x50 overlay at half opacity, in the bottom right corner
+        for channel in rendered.getpixel((150, 75)):
+            self.assertTrue(abs(channel - 128) <= 1)
+        self.assertEqual(rendered.getpixel((99, 49)), (255, 255, 255))
+
+        overlay = get_overlay(self.asset, (100, 50), 0.5)
+        renderer.generate(content)
+        self.assertTrue(get_overlay(self.asset, (100, 50), 0.5) is overlay)
+
+
+class FallbackRelationTestSuite(TestCase):
+
+    def setUp(self):
+        for i in range(3):
+            author = Author.objects.create(name='Author %d' % i,
+                                           avatar='artwork/%08d.jpg' % i)
+            Article.objects.create(title='Article %d' % i, author=author)
+
+    def test_fallback_relations(self):
+        self.assertEqual(get_fallback_relations(Article),
+                         {'author': (Author, set(['avatar']))})
+
+    def test_select_fallbacks(self):
+        """Ensures fallbacks across relations cost no query per row.
+        """
+
+        for only in (False, True):
+            with self.assertNumQueries(1):
+                urls = [article.header.url for article in
+                        Article.objects.select_fallbacks(only=only)]
+
+            self.assertEqual(sorted(urls),
+                             ['artwork/small.%08d.jpg' % i for i in range(3)])
+
+
+class FallbackChainTestSuite(TestCase):
+
+    def setUp(self):
+        # emptiness must be decided without asking storage
+        def url(name):
+            raise AssertionError('storage.url() called for %s' % name)
+
+        self.storage = ChainedPost._meta.get_field('list_image').storage
+        self.storage.url = url
+
+    def tearDown(self):
+        del self.storage.url
+
+    def test_fallback_chain(self):
+        post = ChainedPost(id=1, default_image='artwork/default.jpg')
+        self.assertEqual(post.list_image.name, 'artwork/default.jpg')
+
+        post = ChainedPost(id=1, artwork='artwork/b3d23ba4.jpg',
+                           default_image='artwork/default.jpg')
+        self.assertEqual(post.list_image.name,
+                         'artwork/list.b3d23ba4.jpg')
+
+        post.editorial_image = 'artwork/editorial.jpg'
+        self.assertEqual(post.list_image.name, 'artwork/editorial.jpg')
+
+        post.list_image = 'artwork/override.jpg'
+        self.assertEqual(post.list_image.name, 'artwork/override.jpg')
+
+
+class ShardedLayoutTestSuite(ThumbnailTestCase):
+
+    def test_sharded_layout(self):
+        """Ensures sources and thumbnails share a sharded directory.
+        """
+
+        post = ShardedPost.objects.create(artwork=self.get_test_image())
+        post = ShardedPost.objects.get(id=post.id)
+
+        self.assertEqual(post.artwork.name,
+                         'artwork/b3/d2/b3d23ba4/b3d23ba4.jpg')
+        self.assertEqual(post.artwork.thumbnails.homepage_image.name,
+                         'artwork/b3/d2/b3d23ba4/homepage_image.b3d23ba4.jpg')
+        self.assertTrue(os.path.exists(
+            'artwork/b3/d2/b3d23ba4/homepage_image.b3d23ba4.jpg'))
+
+
+class SweepThumbnailsTestSuite(ThumbnailTestCase):
+
+    def sweep(self, **options):
+        options.setdefault('stdout', StringIO())
+        call_command('sweepthumbnails', content_type='tests.blogpost',
+                     field_name='artwork', min_age=0, chunk_size=2,
+                     **options)
+
+    def test_sweep(self):
+        """Ensures replaced sources and their thumbnails are deleted,
+        and everything referenced is kept.
+        """
+
+        post = BlogPost.objects.create(title='Test Post',
+                                       artwork=self.get_test_image())
+        old_names = [post.artwork.name] + [t.name for t in
+                                           post.artwork.thumbnails]
+
+        post.artwork = self.get_test_thumbnail()
+        post.save()
+        post = BlogPost.objects.get(id=post.id)
+        new_names = [post.artwork.name] + [t.name for t in
+                                           post.artwork.thumbnails]
+
+        self.sweep(dry_run=True)
+        self.assertTrue(all(os.path.exists(name) for name in old_names))
+
+        self.sweep()
+        self.assertFalse(any(os.path.exists(name) for name in old_names))
+        self.assertTrue(all(os.path.exists(name) for name in new_names))
+
+    def test_hidden_rows(self):
+        """Ensures files of rows a default manager hides are kept."""
+
+        post = DraftPost.objects.create(artwork=self.get_test_thumbnail())
+        names = [post.artwork.name] + [t.name for t in
+                                       post.artwork.thumbnails]
+
+        self.sweep()
+        self.assertTrue(all(os.path.exists(name) for name in names))
+
+    def test_sprites(self):
+        """Ensures live sprite sheets and manifests are kept, and
+        replaced sheets deleted.
+        """
+
+        post = BlogPost.objects.create(title='Test Post',
+                                       artwork=self.get_test_image())
+        sheet = SpriteSheet('grid', BlogPost, 'artwork', 'pagination_image',
+                            upload_to='artwork/sprites/')
+        sheet.build([post])
+        image = sheet.manifest['image']
+
+        # a stale sheet, as left by a build interrupted before cleanup
+        sheet.storage.save(image.replace(
+            sheet.manifest['digest'], '0123abcd'), ContentFile('stale'))
+
+        self.sweep()
+        self.assertTrue(os.path.exists(sheet.manifest_name))
+        self.assertTrue(os.path.exists(image))
+        self.assertEqual(sorted(os.listdir('artwork/sprites')),
+                         [os.path.basename(image), 'grid.json'])
+
+
+class CreateThumbnailsTestSuite(ThumbnailTestCase):
+
+    def create_thumbnails(self, **options):
+        stdout = StringIO()
+        call_command('createthumbnails', content_type='tests.focalpointpost',
+                     field_name='artwork', sizes=['banner'], stdout=stdout,
+                     **options)
+        return stdout.getvalue()
+
+    def test_filters(self):
+        first = FocalPointPost.objects.create(artwork=self.get_test_image())
+        second = FocalPointPost.objects.create(
+            artwork=self.get_test_thumbnail())
+
+        output = self.create_thumbnails(min_pk=second.pk)
+        self.assertTrue(second.artwork.url in output)
+        self.assertFalse(first.artwork.url in output)
+
+        output = self.create_thumbnails(filters=['artwork__contains=b3d'])
+        self.assertTrue(first.artwork.url in output)
+        self.assertFalse(second.artwork.url in output)
+
+    def test_estimate(self):
+        FocalPointPost.objects.create(artwork=self.get_test_image())
+        name = FocalPointPost.objects.get().artwork.thumbnails.banner.name
+        os.remove(os.path.realpath(name))
+
+        output = self.create_thumbnails(estimate=True)
+        self.assertTrue('Selected 1 rows, sampled 1.' in output)
+        self.assertTrue('Projected decode: 0.8 megapixels.' in output)
+
+        # estimates never write thumbnails
+        self.assertFalse(os.path.exists(os.path.realpath(name)))
+
+
+class RenderSchedulerTestSuite(TestCase):
+
+    def test_estimate_cost(self):
+        content = ImageFile(open(path('statler_waldorf.jpg')))
+        self.assertEqual(CropRenderer(10, 10).estimate_cost(content),
+                         1024 * 768 * 4 * 2)
+
+    def test_budget(self):
+        """Ensures jobs wait for memory, in order, and time out.
+        """
+
+        scheduler = RenderScheduler(100)
+        cost = scheduler.acquire(60)
+
+        self.assertRaises(RenderTimeout, scheduler.acquire, 60, 0.01)
+
+        admitted = []
+        waiter = threading.Thread(
+            target=lambda: admitted.append(scheduler.acquire(60, 5)))
+        waiter.start()
+        while not scheduler.get_stats()['queue_depth']:
+            time.sleep(0.001)
+        self.assertEqual(admitted, [])
+
+        scheduler.release(cost)
+        waiter.join()
+        self.assertEqual(admitted, [60])
+
+        stats = scheduler.get_stats()
+        self.assertEqual((stats['in_use'], stats['queue_depth'],
+                          stats['admitted'], stats['timeouts']),
+                         (60, 0, 2, 1))
+
+
+class SaveAsyncTestSuite(ThumbnailTestCase):
+
+    def test_save_async(self):
+        """Ensures thumbnails are stored in the background, and the
+        instance saved once they are.
+        """
+
+        post = FocalPointPost()
+        pending = post.artwork.save_async('statler_waldorf.jpg',
+                                          self.get_test_image())
+        self.assertEqual(post.artwork.name, 'artwork/b3d23ba4.jpg')
+        self.assertEqual(post.pk, None)
+
+        pending.wait()
+        self.assertTrue(pending.ready())
+
+        post = FocalPointPost.objects.get(pk=post.pk)
+        for thumbnail in post.artwork.thumbnails:
+            self.assertTrue(post.artwork.storage.exists(thumbnail.name))
+            self.assertEqual(len(thumbnail.color), 7)
+
+
+class BulkIngestTestSuite(ThumbnailTestCase):
+
+    def test_bulk_ingest(self):
+        """Ensures good files are stored and inserted in bulk, and bad
+        ones reported without failing the batch.
+        """
+
+        bad = ContentFile('not an image', name='bad.jpg')
+        items = [(FocalPointPost(), self.get_test_image()),
+                 (FocalPointPost(), bad),
+                 (FocalPointPost(), self.get_test_thumbnail())]
+
+        ingested, errors = bulk_ingest(FocalPointPost, 'artwork', items,
+                                       batch_size=5)
+
+        self.assertEqual(len(ingested), 2)
+        self.assertEqual([instance for instance, e in errors], [items[1][0]])
+
+        posts = FocalPointPost.objects.order_by('artwork')
+        self.assertEqual(len(posts), 2)
+        for post in posts:
+            for thumbnail in post.artwork.thumbnails:
+                self.assertTrue(post.artwork.storage.exists(thumbnail.name))
+                self.assertEqual(len(thumbnail.color), 7)
+
+    def test_failed_render(self):
+        """Ensures sources whose thumbnails fail to render are not left
+        stored.
+        """
+
+        truncated = ContentFile(open(path('statler_waldorf.jpg')).read(2000),
+                                name='truncated.jpg')
+        post = BlogPost(title='Test Post')
+
+        ingested, errors = bulk_ingest(BlogPost, 'artwork',
+                                       [(post, truncated)])
+        self.assertEqual((ingested, len(errors)), ([], 1))
+        self.assertTrue(post.artwork.name)
+        self.assertFalse(post.artwork.storage.exists(post.artwork.name))
+
+
+class TemplateTagTestSuite(ThumbnailTestCase):
+
+    def render(self, source, **context):
+        return Template('{% load undermythumb_tags %}' + source).render(
+            Context(context))
+
+    def test_thumbnail_img(self):
+        """Ensures markup carries dimensions, and is served from cache
+        without touching thumbnails.
+        """
+
+        post = FocalPointPost.objects.create(artwork=self.get_test_image())
+        source = ("{% thumbnail_img post.artwork 'banner' 'landscape' "
+                  "'resized' alt=title %}")
+
+        img = self.render(source, post=post, title='A & B')
+        self.assertEqual(img, (
+            '<img alt="A &amp; B" height="150" '
+            'src="artwork/banner.b3d23ba4.jpg" '
+            'srcset="artwork/banner.b3d23ba4.jpg 300w, '
+            'artwork/landscape.b3d23ba4.jpg 400w" width="300" />'))
+
+        markup = self.render("{% thumbnail_picture post.artwork "
+                             "'(max-width: 600px)' 'banner' 'landscape' %}",
+                             post=post)
+        self.assertEqual(markup, (
+            '<picture><source media="(max-width: 600px)" '
+            'srcset="artwork/banner.b3d23ba4.jpg" />'
+            '<img height="300" src="artwork/landscape.b3d23ba4.jpg" '
+            'width="400" /></picture>'))
+
+        post = FocalPointPost.objects.get(pk=post.pk)
+        post.artwork.thumbnails._populate = None
+        self.assertEqual(self.render(source, post=post, title='A & B'), img)
+
+
+class SpriteSheetTestSuite(ThumbnailTestCase):
+
+    def test_build(self):
+        """Ensures sheets map each tile, and rebuilds copy unchanged
+        tiles from the previous sheet.
+        """
+
+        first = FocalPointPost.objects.create(artwork=self.get_test_image())
+        second = FocalPointPost.objects.create(
+            artwork=self.get_test_thumbnail())
+
+        sheet = SpriteSheet('grid', FocalPointPost, 'artwork', 'banner',
+                            columns=1, upload_to='artwork/sprites/')
+        sheet.build([first, second])
+        self.assertEqual(sheet.get_position(second), (0, 150))
+        self.assertEqual(Image.open(sheet.storage.open(
+            sheet.manifest['image'])).size, (300, 300))
+
+        markup = Template('{% load undermythumb_tags %}'
+                          '{% sprite_style sheet post %}').render(
+            Context({'sheet': sheet, 'post': second}))
+        self.assertEqual(markup, (
+            'background: url(%s) 0 -150px no-repeat; '
+            'width: 300px; height: 150px;' % sheet.url))
+
+        # a moved crop keeps its name, but its tile is rebuilt
+        previous_image = sheet.manifest['image']
+        first.artwork.set_focal_point(0.5, 0.)
+        sheet.build([first, second])
+        self.assertNotEqual(sheet.manifest['image'], previous_image)
+
+        # the first tile can only come from the previous sheet
+        sheet.storage.delete(first.artwork.thumbnails.banner.name)
+        previous_image = sheet.manifest['image']
+        second.artwork.save('statler_waldorf.jpg', self.get_test_image())
+
+        sheet = SpriteSheet('grid', FocalPointPost, 'artwork', 'banner',
+                            columns=1, upload_to='artwork/sprites/')
+        sheet.build([first, second])
+        self.assertNotEqual(sheet.manifest['image'], previous_image)
+        self.assertFalse(sheet.storage.exists(previous_image))
+
+        image = Image.open(sheet.storage.open(sheet.manifest['image']))
+        self.assertNotEqual(image.getpixel((150, 75)), (255, 255, 255))
+
+
+class TestingTestSuite(ThumbnailTestCase):
+
+    def tearDown(self):
+        InMemoryStorage().clear()
+        super(TestingTestSuite, self).tearDown()
+
+    @override_settings(UNDERMYTHUMB_STUB_RENDERS=True)
+    def test_stub_renders(self):
+        """Ensures stubbed renders keep names and fallbacks, record
+        their renderers, and write nothing to disk.
+        """
+
+        with record_renders() as renders:
+            post = InMemoryPost.objects.create(artwork=self.get_test_image())
+
+        specs = InMemoryPost._meta.get_field('artwork').thumbnail_specs
+        self.assertEqual(set(id(renderer) for renderer, options in renders),
+                         set(id(spec.renderer) for spec in specs))
+
+        post = InMemoryPost.objects.get(pk=post.pk)
+        self.assertEqual(post.banner.url, 'artwork/banner.b3d23ba4.jpg')
+        self.assertEqual(post.artwork.storage.listdir('artwork'), ([], [
+            'b3d23ba4.jpg', 'banner.b3d23ba4.jpg', 'resized.b3d23ba4.jpg']))
+        self.assertFalse(os.path.exists(os.path.realpath('./artwork')))
+
+
+class CachedStorageTestSuite(ThumbnailTestCase):
+
+    def tearDown(self):
+        InMemoryStorage().clear()
+        super(CachedStorageTestSuite, self).tearDown()
+
+    def test_cached_storage(self):
+        """Ensures writes reach the remote storage, and hot files are
+        read from local disk, within the size limit.
+        """
+
+        remote = InMemoryStorage()
+        storage = CachedStorage(remote=remote, location='artwork/cache',
+                                max_size=25)
+
+        for name in ('a.jpg', 'b.jpg', 'c.jpg'):
+            storage.save(name, ContentFile(name * 2))
+        storage.flush()
+
+        self.assertEqual(remote.listdir(''), ([], ['a.jpg', 'b.jpg',
+                                                   'c.jpg']))
+        self.assertEqual(sorted(os.listdir('artwork/cache')),
+                         ['b.jpg', 'c.jpg'])
+
+        self.assertEqual(storage.open('c.jpg').read(), 'c.jpgc.jpg')
+        self.assertEqual(storage.open('a.jpg').read(), 'a.jpga.jpg')
+
+        stats = storage.get_stats()
+        self.assertEqual((stats['hits'], stats['misses'],
+                          stats['evictions'], stats['size']),
+                         (1, 1, 2, 20))
+
+        # hits never ask the remote storage
+        calls = []
+        remote.modified_time = lambda name: calls.append(name)
+        for i in range(5):
+            storage.open('c.jpg').read()
+        self.assertEqual(calls, [])
+        self.assertEqual(storage.get_stats()['hits'], 6)
+
+    def test_validate_interval(self):
+        """Ensures copies overwritten elsewhere are fetched again, with
+        at most one check per interval.
+        """
+
+        remote = InMemoryStorage()
+        storage = CachedStorage(remote=remote, location='artwork/cache',
+                                validate_interval=60)
+        storage.save('c.jpg', ContentFile('old'))
+        storage.flush()
+
+        time.sleep(0.01)
+        publish(remote, 'c.jpg', ContentFile('new'))
+        self.assertEqual(storage.open('c.jpg').read(), 'old')
+
+        storage.validate_interval = 0
+        self.assertEqual(storage.open('c.jpg').read(), 'new')
+        self.assertEqual(open('artwork/cache/c.jpg').read(), 'new')
+        self.assertEqual(storage.open('c.jpg').read(), 'new')
+
+        stats = storage.get_stats()
+        self.assertEqual((stats['hits'], stats['revalidations'],
+                          stats['misses']), (1, 1, 1))
+
+    def test_scan(self):
+        """Ensures files already on disk count towards the limit."""
+
+        remote = InMemoryStorage()
+        storage = CachedStorage(remote=remote, location='artwork/cache')
+        for name in ('a.jpg', 'b.jpg', 'c.jpg'):
+            storage.save(name, ContentFile(name * 2))
+        storage.flush()
+
+        # a restarted process sees, and evicts, the files cached before
+        storage = CachedStorage(remote=remote, location='artwork/cache',
+                                max_size=25)
+        self.assertEqual(storage.get_stats()['size'], 30)
+        storage.open('a.jpg')
+        storage.save('d.jpg', ContentFile('d'))
+        storage.flush()
+
+        self.assertEqual(sorted(os.listdir('artwork/cache')),
+                         ['a.jpg', 'c.jpg', 'd.jpg'])
+
+        # rescans, in the background, count other processes' files
+        storage.rescan_interval = 0
+        other = CachedStorage(remote=remote, location='artwork/cache')
+        other.save('e.jpg', ContentFile('e.jpge.jpg'))
+        other.flush()
+        storage.save('f.jpg', ContentFile('f'))
+        storage.flush()
+        for i in range(100):
+            if not storage._scanning:
+                break
+            time.sleep(0.01)
+        self.assertIn('e.jpg', storage._index)
+        self.assertLessEqual(storage.get_stats()['size'], 25)
+        self.assertTrue(os.path.exists('artwork/cache/e.jpg'))
+
+
+class PublishTestSuite(ThumbnailTestCase):
+
+    def test_publish(self):
+        """Ensures republishing keeps names predictable, replaces
+        contents, and leaves no temporary files behind.
+        """
+
+        for storage in (FileSystemStorage(), AtomicFileSystemStorage()):
+            for data in ('first', 'second'):
+                name = publish(storage, 'artwork/thumb.jpg',
+                               ContentFile(data))
+                self.assertEqual(name, 'artwork/thumb.jpg')
+                self.assertEqual(storage.open(name).read(), data)
+
+            self.assertEqual(storage.listdir('artwork'),
+                             ([], ['thumb.jpg']))
+
+    def test_atomic_save(self):
+        """Ensures ordinary saves keep colliding uploads apart."""
+
+        storage = AtomicFileSystemStorage()
+        first = storage.save('artwork/photo.jpg', ContentFile('first'))
+        second = storage.save('artwork/photo.jpg', ContentFile('second'))
+
+        self.assertNotEqual(first, second)
+        self.assertEqual(storage.open(first).read(), 'first')
+        self.assertEqual(storage.open(second).read(), 'second')
+        self.assertEqual(len(storage.listdir('artwork')[1]), 2)